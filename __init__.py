@@ -4,21 +4,55 @@
 from trytond.pool import Pool
 from .configuration import *
 from .training import *
+from .ir import *
+from .company import *
+from .res import *
+from .product import *
+from .subscription_import import *
+from .archive import *
 
 def register():
     Pool.register(
         TrainingSequences,
         TrainingConfiguration,
         ConfigurationProduct,
+        ConfigurationModel,
         TrainingSubscription,
         TrainingSubscriptionLine,
         TrainingSubscriptionSale,
         TrainingSubscriptionInvoice,
         TrainingSubscriptionHistory,
+        TrainingSubscriptionHistoryPhase,
+        TrainingSubscriptionPhaseStatistics,
+        OpenPhaseStatisticsStart,
+        TrainingSubscriptionForecast,
+        OpenForecastStart,
+        ImportSubscriptionStart,
+        ImportSubscriptionResult,
+        TrainingSubscriptionOccurrence,
+        TrainingSubscriptionQueue,
+        SubscriptionArchive,
+        SubscriptionLineArchive,
+        SubscriptionHistoryArchive,
+        SubscriptionSaleArchive,
+        SubscriptionInvoiceArchive,
         TrainingOffer,
         Sale,
         TrainingSession,
+        Model,
+        Company,
+        User,
+        PriceList,
+        PriceListLine,
+        Template,
+        Product,
         module='training_subscription', type_='model')
+    Pool.register(
+        ModuleInstallUpgrade,
+        OpenPhaseStatistics,
+        OpenForecast,
+        ImportSubscription,
+        module='training_subscription', type_='wizard')
     Pool.register(
         SubscriptionReport,
         module='training_subscription', type_='report')
\ No newline at end of file
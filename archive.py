@@ -0,0 +1,296 @@
+# This file is part of subscription module of Tryton.
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from datetime import datetime, timedelta
+
+from sql import Column, Null
+from sql.conditionals import Coalesce
+from trytond.model import ModelView, ModelSQL, fields
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+from .training import INVOICE, MEDIA
+
+__all__ = ['SubscriptionArchive', 'SubscriptionLineArchive',
+    'SubscriptionHistoryArchive', 'SubscriptionSaleArchive',
+    'SubscriptionInvoiceArchive']
+
+# Subscription states which are archived. The stopped subscriptions are
+# kept as they can be resumed from their schedule and occurrences, which are
+# not archived. The canceled ones can be reset to draft once restored.
+ARCHIVE_STATES = ['done', 'cancel']
+
+# The archived models with their archive and the field linking them to the
+# subscription, parents first
+ARCHIVES = [
+    ('training.subscription', 'training.subscription.archive', 'id'),
+    ('training.subscription.line', 'training.subscription.line.archive',
+        'subscription'),
+    ('training.subscription.history',
+        'training.subscription.history.archive', 'subscription'),
+    ('training.subscription-sale.sale',
+        'training.subscription.archive-sale.sale', 'subscription'),
+    ('training.subscription-account.invoice',
+        'training.subscription.archive-account.invoice', 'subscription'),
+    ]
+
+
+def _get_columns(Model, Archive):
+    '''
+    Return the names of the columns shared by Model and its Archive
+    '''
+    return sorted(name for name, field in Archive._fields.iteritems()
+        if name in Model._fields
+        and not isinstance(field, fields.Function)
+        and field._type not in ('one2many', 'many2many'))
+
+
+class SubscriptionArchive(ModelSQL, ModelView):
+    'Training Subscription Archive'
+    __name__ = 'training.subscription.archive'
+
+    company = fields.Many2One('company.company', 'Company', readonly=True,
+        select=True)
+    code = fields.Char('Code', readonly=True, select=True)
+    description = fields.Char('Description', readonly=True)
+    date = fields.Date('Date', readonly=True)
+    subscriptor = fields.Many2One('party.party', 'Subscriptor',
+        readonly=True)
+    student = fields.Many2One('training.student', 'Student', readonly=True)
+    invoice_method = fields.Selection(INVOICE, 'Invoice Method',
+        readonly=True)
+    state = fields.Selection([
+            ('done', 'Done'),
+            ('cancel', 'Canceled'),
+            ], 'State', readonly=True)
+    lines = fields.One2Many('training.subscription.line.archive',
+        'subscription', 'Subscription Lines', readonly=True)
+    history = fields.One2Many('training.subscription.history.archive',
+        'subscription', 'History', readonly=True)
+    price_list = fields.Many2One('product.price_list', 'Price List',
+        readonly=True)
+    currency = fields.Many2One('currency.currency', 'Currency',
+        readonly=True)
+    payment_term = fields.Many2One('account.invoice.payment_term',
+        'Payment Term', readonly=True)
+    media_contact = fields.Selection(MEDIA, 'Media Contact', readonly=True)
+    salesman = fields.Many2One('company.employee', 'Educative Salesman',
+        readonly=True)
+    sales = fields.Many2Many('training.subscription.archive-sale.sale',
+        'subscription', 'sale', 'Sales', readonly=True)
+    invoices = fields.Many2Many(
+        'training.subscription.archive-account.invoice',
+        'subscription', 'invoice', 'Invoices', readonly=True)
+    active = fields.Boolean('Active', readonly=True)
+    user = fields.Many2One('res.user', 'User', readonly=True)
+    request_user = fields.Many2One('res.user', 'Request User',
+        readonly=True)
+    request_group = fields.Many2One('res.group', 'Request Group',
+        readonly=True)
+    interval_number = fields.Integer('Interval Qty', readonly=True)
+    interval_type = fields.Selection([
+            ('minutes', 'Minutes'),
+            ('hours', 'Hours'),
+            ('days', 'Days'),
+            ('weeks', 'Weeks'),
+            ('months', 'Months')
+            ], 'Interval Unit', readonly=True)
+    next_call = fields.DateTime('First Date', readonly=True)
+    number_calls = fields.Integer('Number of documents', readonly=True)
+    remaining_calls = fields.Integer('Remaining Documents', readonly=True)
+    model_source = fields.Reference('Source Document',
+        selection='get_model', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(SubscriptionArchive, cls).__setup__()
+        cls._order.insert(0, ('date', 'DESC'))
+        cls._buttons.update({
+                'restore': {},
+                })
+
+    @classmethod
+    def get_model(cls):
+        Configuration = Pool().get('training.configuration')
+        return Configuration.get_source_models()
+
+    @classmethod
+    def archive(cls):
+        '''
+        Move the done and canceled subscriptions which were not modified
+        for the archive age of the configuration into the archive tables.
+        Each chunk is committed on its own.
+        '''
+        pool = Pool()
+        Configuration = pool.get('training.configuration')
+        Subscription = pool.get('training.subscription')
+        subscription = Subscription.__table__()
+        cursor = Transaction().cursor
+
+        age = Configuration(1).archive_age
+        if not age:
+            return
+        limit = datetime.now() - timedelta(days=age)
+        while True:
+            cursor.execute(*subscription.select(subscription.id,
+                    where=subscription.state.in_(ARCHIVE_STATES)
+                    & (Coalesce(subscription.write_date,
+                            subscription.create_date) < limit),
+                    limit=cursor.IN_MAX))
+            subscription_ids = [i for i, in cursor.fetchall()]
+            if not subscription_ids:
+                break
+            cls._archive(subscription_ids)
+            cursor.commit()
+
+    @classmethod
+    def _archive(cls, subscription_ids):
+        pool = Pool()
+        for model, archive, field in ARCHIVES:
+            Model, Archive = pool.get(model), pool.get(archive)
+            cls._copy_rows(Model, Archive, field, subscription_ids)
+        cls._delete_unarchived(subscription_ids)
+        # The archived rows are moved with raw queries which are limited to
+        # the tables of this module: the records are moved with their ids,
+        # not deleted, so the delete checks of the models must not run.
+        # Delete the children first
+        for model, archive, field in reversed(ARCHIVES):
+            Model = pool.get(model)
+            table = Model.__table__()
+            Transaction().cursor.execute(*table.delete(
+                    where=Column(table, field).in_(subscription_ids)))
+
+    @staticmethod
+    def _delete_unarchived(subscription_ids):
+        '''
+        Delete the records of the subscriptions which are not archived.
+        They are deleted explicitly with their models as not all the
+        backends enforce the foreign keys.
+        '''
+        pool = Pool()
+        Subscription = pool.get('training.subscription')
+        Phase = pool.get('training.subscription.history.phase')
+        Occurrence = pool.get('training.subscription.occurrence')
+        Queue = pool.get('training.subscription.queue')
+        Cron = pool.get('ir.cron')
+        subscription = Subscription.__table__()
+        cursor = Transaction().cursor
+
+        Phase.delete(Phase.search([
+                    ('history.subscription', 'in', subscription_ids),
+                    ]))
+        Occurrence.delete(Occurrence.search([
+                    ('subscription', 'in', subscription_ids),
+                    ]))
+        Queue.delete(Queue.search([
+                    ('subscription', 'in', subscription_ids),
+                    ]))
+        crons = [s.cron for s in Subscription.browse(subscription_ids)
+            if s.cron]
+        if crons:
+            # Unlink first as the scheduler deletion cascades to the
+            # subscription
+            cursor.execute(*subscription.update(
+                    columns=[subscription.cron], values=[Null],
+                    where=subscription.id.in_(subscription_ids)))
+            Cron.delete(crons)
+
+    @classmethod
+    @ModelView.button
+    def restore(cls, archives):
+        '''
+        Move the archived subscriptions back into the subscription tables
+        and validate them again
+        '''
+        pool = Pool()
+        Subscription = pool.get('training.subscription')
+        Line = pool.get('training.subscription.line')
+        cursor = Transaction().cursor
+
+        ids = [a.id for a in archives]
+        for i in range(0, len(ids), cursor.IN_MAX):
+            sub_ids = ids[i:i + cursor.IN_MAX]
+            for model, archive, field in ARCHIVES:
+                Model, Archive = pool.get(model), pool.get(archive)
+                cls._copy_rows(Archive, Model, field, sub_ids)
+            for model, archive, field in reversed(ARCHIVES):
+                Archive = pool.get(archive)
+                table = Archive.__table__()
+                cursor.execute(*table.delete(
+                        where=Column(table, field).in_(sub_ids)))
+            # The raw copy skips the validation of the ORM
+            subscriptions = Subscription.browse(sub_ids)
+            Subscription._validate(subscriptions)
+            Line._validate([l for s in subscriptions for l in s.lines])
+
+    @staticmethod
+    def _copy_rows(Source, Target, field, subscription_ids):
+        '''
+        Copy the rows of Source linked to the subscriptions into Target,
+        keeping their ids
+        '''
+        source = Source.__table__()
+        target = Target.__table__()
+        cursor = Transaction().cursor
+
+        columns = _get_columns(Source, Target)
+        cursor.execute(*target.insert([Column(target, c) for c in columns],
+                source.select(*[Column(source, c) for c in columns],
+                    where=Column(source, field).in_(subscription_ids))))
+
+
+class SubscriptionLineArchive(ModelSQL, ModelView):
+    'Training Subscription Line Archive'
+    __name__ = 'training.subscription.line.archive'
+
+    subscription = fields.Many2One('training.subscription.archive',
+        'Subscription', required=True, ondelete='CASCADE', select=True,
+        readonly=True)
+    session = fields.Many2One('training.session', 'Session', readonly=True,
+        select=True)
+    unit_price = fields.Numeric('Unit Price', digits=(16, 2), readonly=True)
+    quantity = fields.Numeric('Quantity', digits=(16, 2), readonly=True)
+    uom = fields.Many2One('product.uom', 'UOM', readonly=True)
+    number_calls = fields.Integer('Number of documents', readonly=True)
+    notes = fields.Char('Notes', readonly=True)
+
+
+class SubscriptionHistoryArchive(ModelSQL, ModelView):
+    'Subscription History Archive'
+    __name__ = 'training.subscription.history.archive'
+    _rec_name = 'date'
+
+    date = fields.DateTime('Date', readonly=True)
+    log = fields.Char('Result', readonly=True)
+    subscription = fields.Many2One('training.subscription.archive',
+        'Subscription', ondelete='CASCADE', select=True, readonly=True)
+    document = fields.Reference('Created Document', selection='get_model',
+        readonly=True)
+    success = fields.Boolean('Success', readonly=True)
+
+    @classmethod
+    def get_model(cls):
+        Configuration = Pool().get('training.configuration')
+        return Configuration.get_source_models()
+
+
+class SubscriptionSaleArchive(ModelSQL):
+    'Training Subscription Archive - Sale'
+    __name__ = 'training.subscription.archive-sale.sale'
+    _table = 'subscription_sales_archive_rel'
+
+    subscription = fields.Many2One('training.subscription.archive',
+        'Subscription', ondelete='CASCADE', select=True, required=True)
+    sale = fields.Many2One('sale.sale', 'Sale', ondelete='RESTRICT',
+        select=True, required=True)
+
+
+class SubscriptionInvoiceArchive(ModelSQL):
+    'Training Subscription Archive - Invoice'
+    __name__ = 'training.subscription.archive-account.invoice'
+    _table = 'subscription_invoices_archive_rel'
+
+    subscription = fields.Many2One('training.subscription.archive',
+        'Subscription', ondelete='CASCADE', select=True, required=True)
+    invoice = fields.Many2One('account.invoice', 'Invoice',
+        ondelete='RESTRICT', select=True, required=True)
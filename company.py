@@ -0,0 +1,17 @@
+# This file is part of subscription module of Tryton.
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from trytond.pool import Pool, PoolMeta
+
+__all__ = ['Company']
+__metaclass__ = PoolMeta
+
+
+class Company:
+    __name__ = 'company.company'
+
+    @classmethod
+    def write(cls, companies, values):
+        Configuration = Pool().get('training.configuration')
+        super(Company, cls).write(companies, values)
+        Configuration._values_cache.clear()
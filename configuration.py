@@ -13,10 +13,14 @@
 #
 ##############################################################################
 from trytond.model import ModelView, ModelSingleton, ModelSQL, fields
+from trytond.cache import Cache
+from trytond.pool import Pool
+from trytond.transaction import Transaction
 
 __all__ = ['TrainingSequences',
            'TrainingConfiguration',
-           'ConfigurationProduct']
+           'ConfigurationProduct',
+           'ConfigurationModel']
 
 # TRAINING SEQUENCES
 class TrainingSequences(ModelSingleton, ModelSQL, ModelView):
@@ -26,6 +30,22 @@ class TrainingSequences(ModelSingleton, ModelSQL, ModelView):
     subscription_sequence = fields.Property(fields.Many2One(
         'ir.sequence', 'Subscription Sequence', required=True,
         domain=[('code', '=', 'training.subscription')]))
+
+    @classmethod
+    def create(cls, vlist):
+        sequences = super(TrainingSequences, cls).create(vlist)
+        TrainingConfiguration._values_cache.clear()
+        return sequences
+
+    @classmethod
+    def write(cls, sequences, values):
+        super(TrainingSequences, cls).write(sequences, values)
+        TrainingConfiguration._values_cache.clear()
+
+    @classmethod
+    def delete(cls, sequences):
+        super(TrainingSequences, cls).delete(sequences)
+        TrainingConfiguration._values_cache.clear()
     
 class TrainingConfiguration(ModelSingleton, ModelSQL, ModelView):
     'Training Subscription Configuration'
@@ -33,6 +53,164 @@ class TrainingConfiguration(ModelSingleton, ModelSQL, ModelView):
 
     default_charges = fields.Many2Many('training.configuration-product.product', 
         'configuration', 'product', 'Default Charges')
+    scheduler = fields.Selection([
+            ('dispatcher', 'Dispatcher'),
+            ('cron', 'Scheduler per Subscription'),
+            ], 'Scheduler', required=True,
+        help='Dispatcher bills all the due subscriptions from a single '
+            'scheduler instead of creating one per subscription.')
+
+    source_models = fields.Many2Many('training.configuration-ir.model',
+        'configuration', 'model', 'Source Models',
+        help='Models allowed as source document of the subscriptions.\n'
+            'Leave empty to allow all models.')
+    _source_models_cache = Cache('training.configuration.get_source_models')
+    _values_cache = Cache('training.configuration.values')
+    billing_workers = fields.Integer('Billing Workers', required=True,
+        help='Number of processes billing the due subscriptions in '
+            'parallel.\nOnly used by the dispatcher on PostgreSQL 9.5 or '
+            'later.')
+
+    stagger_window = fields.Integer('Stagger Window',
+        help='Number of minutes over which the billing of the occurrences '
+            'due at the same time is spread.\n'
+            'The billing date of the documents is not changed.')
+    stagger_quota = fields.Integer('Hourly Quota',
+        help='Maximum number of occurrences billed per hour and company.\n'
+            'Leave empty for no limit.')
+    archive_age = fields.Integer('Archive Age',
+        help='Number of days after which the done and canceled '
+            'subscriptions are moved to the archive.\n'
+            'Leave empty to never archive.')
+    catch_up = fields.Boolean('Catch Up',
+        help='Bill at once all the occurrences missed while the scheduler '
+            'was down, each dated on its own period.\n'
+            'Only used by the dispatcher.')
+    confirmation = fields.Selection([
+            ('immediate', 'Immediate'),
+            ('deferred', 'Deferred'),
+            ], 'Confirmation', required=True,
+        help='Deferred confirmation queues the creation of the sales and '
+            'invoices for a background worker.')
+    queue_max_attempts = fields.Integer('Queue Maximum Attempts',
+        required=True,
+        help='Number of times a queued confirmation is tried before it is '
+            'marked as failed.')
+
+    @staticmethod
+    def default_scheduler():
+        return 'dispatcher'
+
+    @staticmethod
+    def default_catch_up():
+        return False
+
+    @staticmethod
+    def default_confirmation():
+        return 'immediate'
+
+    @staticmethod
+    def default_queue_max_attempts():
+        return 5
+
+    @staticmethod
+    def default_billing_workers():
+        return 1
+
+    @classmethod
+    def create(cls, vlist):
+        configurations = super(TrainingConfiguration, cls).create(vlist)
+        cls._source_models_cache.clear()
+        cls._values_cache.clear()
+        return configurations
+
+    @classmethod
+    def write(cls, configurations, values):
+        super(TrainingConfiguration, cls).write(configurations, values)
+        cls._source_models_cache.clear()
+        cls._values_cache.clear()
+
+    @classmethod
+    def delete(cls, configurations):
+        super(TrainingConfiguration, cls).delete(configurations)
+        cls._source_models_cache.clear()
+        cls._values_cache.clear()
+
+    @classmethod
+    def _get_value(cls, name, getter, *args):
+        '''
+        Return the value computed by getter, cached per company
+        '''
+        key = (name, Transaction().context.get('company')) + args
+        value = cls._values_cache.get(key)
+        if value is None:
+            value = getter(*args)
+            cls._values_cache.set(key, value)
+        return value
+
+    @classmethod
+    def get_default_charges(cls):
+        '''
+        Return the ids of the default charge products
+        '''
+        return cls._get_value('default_charges',
+            lambda: tuple(p.id for p in cls(1).default_charges))
+
+    @classmethod
+    def get_subscription_sequence(cls):
+        '''
+        Return the id of the subscription sequence
+        '''
+        Sequences = Pool().get('training.sequences')
+        return cls._get_value('subscription_sequence',
+            lambda: Sequences(1).subscription_sequence.id)
+
+    @classmethod
+    def get_cron_user(cls):
+        '''
+        Return the id of the user running the scheduled subscriptions
+        '''
+        def getter():
+            User = Pool().get('res.user')
+            users = User.search([
+                    ('active', '=', False),
+                    ('login', '=', 'user_cron_trigger'),
+                    ])
+            return users[0].id
+        return cls._get_value('cron_user', getter)
+
+    @classmethod
+    def get_company_currency(cls, company_id):
+        '''
+        Return the currency id of the company
+        '''
+        Company = Pool().get('company.company')
+        return cls._get_value('company_currency',
+            lambda c: Company(c).currency.id, company_id)
+
+    @classmethod
+    def get_source_models(cls):
+        '''
+        Return the selection of the source document models
+        '''
+        models = cls._source_models_cache.get('models')
+        if models is not None:
+            return models
+
+        configuration = cls(1)
+        if configuration.source_models:
+            models = sorted(((m.model, m.name)
+                    for m in configuration.source_models),
+                key=lambda m: m[1])
+        else:
+            IrModel = Pool().get('ir.model')
+            ir_model = IrModel.__table__()
+            cursor = Transaction().cursor
+            cursor.execute(*ir_model.select(ir_model.model, ir_model.name,
+                    order_by=ir_model.name))
+            models = cursor.fetchall()
+        cls._source_models_cache.set('models', models)
+        return models
 
 class ConfigurationProduct(ModelSQL):
     'Configuration - Product'
@@ -44,6 +222,17 @@ class ConfigurationProduct(ModelSQL):
     product = fields.Many2One('product.product', 'Product',
             ondelete='RESTRICT', select=True, required=True)
 
+
+class ConfigurationModel(ModelSQL):
+    'Configuration - Model'
+    __name__ = 'training.configuration-ir.model'
+    _table = 'training_configuration_model_rel'
+
+    configuration = fields.Many2One('training.configuration', 'Configuration',
+            ondelete='CASCADE', select=True, required=True)
+    model = fields.Many2One('ir.model', 'Model',
+            ondelete='CASCADE', select=True, required=True)
+
     
 
-## create default charges
\ No newline at end of file
+## create default charges
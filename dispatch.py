@@ -0,0 +1,63 @@
+# This file is part of subscription module of Tryton.
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+'''
+Billing worker of the dispatcher.
+
+The dispatcher starts each worker in a new interpreter, so nothing is
+inherited from the server process:
+
+    python -m trytond.modules.training_subscription.dispatch [config file]
+
+The worker reads the database name, the user, the context, the chunk size
+and the subscription ids as JSON on its standard input. It writes the
+number of subscriptions billed on its standard output.
+'''
+import json
+import logging
+import sys
+
+__all__ = ['dispatch', 'main']
+
+
+def dispatch(database_name, user, context, subscription_ids, chunk):
+    '''
+    Bill the subscription ids in chunks, each in its own transaction.
+    Return the number of subscriptions billed.
+    '''
+    from trytond.pool import Pool
+    from trytond.transaction import Transaction
+
+    logger = logging.getLogger('training_subscription')
+    billed = 0
+    for i in range(0, len(subscription_ids), chunk):
+        sub_ids = subscription_ids[i:i + chunk]
+        with Transaction().start(database_name, user, context=context):
+            Subscription = Pool().get('training.subscription')
+            cursor = Transaction().cursor
+            try:
+                billed += Subscription._dispatch_claimed(sub_ids)
+                cursor.commit()
+            except Exception:
+                cursor.rollback()
+                logger.error('Error billing subscriptions %s' % sub_ids,
+                    exc_info=True)
+    return billed
+
+
+def main(config_file=None):
+    from trytond.config import CONFIG
+    CONFIG.update_etc(config_file)
+    from trytond.pool import Pool
+
+    logging.basicConfig(level=logging.INFO)
+    args = json.load(sys.stdin)
+    Pool.start()
+    Pool(args['database']).init()
+    billed = dispatch(args['database'], args['user'], args['context'],
+        args['subscriptions'], args['chunk'])
+    sys.stdout.write('%s\n' % billed)
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:2])
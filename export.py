@@ -0,0 +1,265 @@
+# This file is part of subscription module of Tryton.
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+'''
+Export of the subscriptions with their lines, sales and invoices.
+
+It can be run as a command which streams the export to a file:
+
+    python -m trytond.modules.training_subscription.export [options] database
+'''
+import csv
+import datetime
+import json
+import sys
+from decimal import Decimal
+from optparse import OptionParser
+
+from sql import Literal, Union
+from sql.aggregate import Sum
+from sql.conditionals import Coalesce
+from trytond import backend
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+__all__ = ['export_rows', 'export_csv', 'export_jsonl', 'main']
+
+# Number of rows fetched at once from the database
+EXPORT_FETCH = 1000
+
+KINDS = ['subscription', 'line', 'sale', 'invoice']
+
+COLUMNS = ['kind', 'subscription', 'code', 'company', 'state', 'date',
+    'record', 'reference', 'record_date', 'record_state', 'quantity',
+    'unit_price', 'amount']
+
+
+def _get_untaxed(table):
+    return Coalesce(table.quantity, 0) * Coalesce(table.unit_price, 0)
+
+
+def _get_query(company=None, states=None, from_date=None, to_date=None):
+    '''
+    Return the query of the subscriptions with their lines, sales and
+    invoices, one row per record.
+    The amounts of the sales and invoices are untaxed.
+    '''
+    pool = Pool()
+    Subscription = pool.get('training.subscription')
+    Line = pool.get('training.subscription.line')
+    Session = pool.get('training.session')
+    SubscriptionSale = pool.get('training.subscription-sale.sale')
+    SubscriptionInvoice = pool.get('training.subscription-account.invoice')
+    Sale = pool.get('sale.sale')
+    SaleLine = pool.get('sale.line')
+    Invoice = pool.get('account.invoice')
+    InvoiceLine = pool.get('account.invoice.line')
+    subscription = Subscription.__table__()
+    line = Line.__table__()
+    session = Session.__table__()
+    subscription_sale = SubscriptionSale.__table__()
+    subscription_invoice = SubscriptionInvoice.__table__()
+    sale = Sale.__table__()
+    sale_line = SaleLine.__table__()
+    invoice = Invoice.__table__()
+    invoice_line = InvoiceLine.__table__()
+
+    where = Literal(True)
+    if company:
+        where &= subscription.company == company
+    if states:
+        where &= subscription.state.in_(states)
+    if from_date:
+        where &= subscription.date >= from_date
+    if to_date:
+        where &= subscription.date <= to_date
+
+    def header(kind):
+        return [Literal(KINDS.index(kind)).as_('sequence'),
+            Literal(kind).as_('kind'),
+            subscription.id.as_('subscription'),
+            subscription.code.as_('code'),
+            subscription.company.as_('company'),
+            subscription.state.as_('state'),
+            subscription.date.as_('date')]
+
+    subscriptions = subscription.select(*(header('subscription') + [
+                Literal(None).as_('record'),
+                subscription.description.as_('reference'),
+                Literal(None).as_('record_date'),
+                Literal(None).as_('record_state'),
+                Literal(None).as_('quantity'),
+                Literal(None).as_('unit_price'),
+                Literal(None).as_('amount'),
+                ]),
+        where=where)
+    lines = subscription.join(line,
+        condition=line.subscription == subscription.id
+        ).join(session, 'LEFT', condition=line.session == session.id
+        ).select(*(header('line') + [
+                line.id.as_('record'),
+                session.name.as_('reference'),
+                Literal(None).as_('record_date'),
+                Literal(None).as_('record_state'),
+                line.quantity.as_('quantity'),
+                line.unit_price.as_('unit_price'),
+                Line._get_amount_column(line).as_('amount'),
+                ]),
+        where=where)
+    sales = subscription.join(subscription_sale,
+        condition=subscription_sale.subscription == subscription.id
+        ).join(sale, condition=subscription_sale.sale == sale.id
+        ).select(*(header('sale') + [
+                sale.id.as_('record'),
+                Coalesce(sale.reference, sale.subscription_code
+                    ).as_('reference'),
+                sale.sale_date.as_('record_date'),
+                sale.state.as_('record_state'),
+                Literal(None).as_('quantity'),
+                Literal(None).as_('unit_price'),
+                sale_line.select(Sum(_get_untaxed(sale_line)),
+                    where=(sale_line.sale == sale.id)
+                    & (sale_line.type == 'line')).as_('amount'),
+                ]),
+        where=where)
+    invoices = subscription.join(subscription_invoice,
+        condition=subscription_invoice.subscription == subscription.id
+        ).join(invoice, condition=subscription_invoice.invoice == invoice.id
+        ).select(*(header('invoice') + [
+                invoice.id.as_('record'),
+                invoice.number.as_('reference'),
+                invoice.invoice_date.as_('record_date'),
+                invoice.state.as_('record_state'),
+                Literal(None).as_('quantity'),
+                Literal(None).as_('unit_price'),
+                invoice_line.select(Sum(_get_untaxed(invoice_line)),
+                    where=(invoice_line.invoice == invoice.id)
+                    & (invoice_line.type == 'line')).as_('amount'),
+                ]),
+        where=where)
+    return Union(subscriptions, lines, sales, invoices, all_=True)
+
+
+def export_rows(company=None, states=None, from_date=None, to_date=None):
+    '''
+    Yield the export rows as tuples of COLUMNS.
+    On PostgreSQL the rows are read through a server-side cursor so the
+    memory used does not depend on the number of rows.
+    '''
+    transaction = Transaction()
+    cursor = transaction.cursor
+    query = _get_query(company=company, states=states, from_date=from_date,
+        to_date=to_date)
+    query, params = tuple(query)
+    query = ('SELECT %s FROM (%s) AS "export" '
+        'ORDER BY "subscription", "sequence", "record"' % (
+            ', '.join('"%s"' % c for c in COLUMNS), query))
+
+    if backend.name() == 'postgresql':
+        # Named cursors are kept on the server and fetched by chunks
+        server_cursor = cursor._conn.cursor('training_subscription_export')
+        server_cursor.itersize = EXPORT_FETCH
+        try:
+            server_cursor.execute(query, params)
+            for row in server_cursor:
+                yield row
+        finally:
+            server_cursor.close()
+    else:
+        cursor.execute(query, params)
+        while True:
+            rows = cursor.fetchmany(EXPORT_FETCH)
+            if not rows:
+                break
+            for row in rows:
+                yield row
+
+
+def _format(value):
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return str(value)
+    return value
+
+
+def export_csv(file_, **filters):
+    '''
+    Write the export rows to file_ as CSV and return the number of rows
+    '''
+    writer = csv.writer(file_)
+    writer.writerow(COLUMNS)
+    count = 0
+    for row in export_rows(**filters):
+        writer.writerow([_format(v) for v in row])
+        count += 1
+    return count
+
+
+def export_jsonl(file_, **filters):
+    '''
+    Write the export rows to file_ as JSON Lines and return the number of
+    rows
+    '''
+    count = 0
+    for row in export_rows(**filters):
+        file_.write(json.dumps(dict(zip(COLUMNS,
+                        (_format(v) for v in row))), sort_keys=True) + '\n')
+        count += 1
+    return count
+
+
+def main(args=None):
+    parser = OptionParser(usage='%prog [options] database')
+    parser.add_option('-c', '--config', dest='config',
+        help='specify the trytond config file')
+    parser.add_option('-o', '--output', dest='output',
+        help='write the export to the file instead of the standard output')
+    parser.add_option('-f', '--format', dest='format', default='csv',
+        choices=['csv', 'jsonl'], help='csv (default) or jsonl')
+    parser.add_option('--company', dest='company', type='int',
+        help='export only the subscriptions of the company id')
+    parser.add_option('--state', dest='states', action='append',
+        help='export only the subscriptions in the state, may be repeated')
+    parser.add_option('--from-date', dest='from_date',
+        help='export only the subscriptions from the date (YYYY-MM-DD)')
+    parser.add_option('--to-date', dest='to_date',
+        help='export only the subscriptions until the date (YYYY-MM-DD)')
+    options, args = parser.parse_args(args)
+    if len(args) != 1:
+        parser.error('the database is required')
+    database_name, = args
+
+    def parse_date(value):
+        if not value:
+            return None
+        try:
+            return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+        except ValueError:
+            parser.error('wrong date "%s"' % value)
+
+    filters = {
+        'company': options.company,
+        'states': options.states,
+        'from_date': parse_date(options.from_date),
+        'to_date': parse_date(options.to_date),
+        }
+
+    from trytond.config import CONFIG
+    CONFIG.update_etc(options.config)
+    Pool.start()
+    Pool(database_name).init()
+
+    export = export_jsonl if options.format == 'jsonl' else export_csv
+    file_ = open(options.output, 'wb') if options.output else sys.stdout
+    try:
+        with Transaction().start(database_name, 0):
+            count = export(file_, **filters)
+    finally:
+        if options.output:
+            file_.close()
+    sys.stderr.write('%s rows exported\n' % count)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+# This file is part of subscription module of Tryton.
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from trytond.pool import Pool, PoolMeta
+
+__all__ = ['Model', 'ModuleInstallUpgrade']
+__metaclass__ = PoolMeta
+
+
+class Model:
+    __name__ = 'ir.model'
+
+    @classmethod
+    def create(cls, vlist):
+        models = super(Model, cls).create(vlist)
+        cls._clear_source_models()
+        return models
+
+    @classmethod
+    def write(cls, models, values):
+        super(Model, cls).write(models, values)
+        cls._clear_source_models()
+
+    @classmethod
+    def delete(cls, models):
+        super(Model, cls).delete(models)
+        cls._clear_source_models()
+
+    @staticmethod
+    def _clear_source_models():
+        try:
+            Configuration = Pool().get('training.configuration')
+        except KeyError:
+            # The module has been removed by the upgrade
+            return
+        Configuration._source_models_cache.clear()
+
+
+class ModuleInstallUpgrade:
+    __name__ = 'ir.module.module.install_upgrade'
+
+    def transition_upgrade(self):
+        # The models of the installed modules are registered by the upgrade
+        state = super(ModuleInstallUpgrade, self).transition_upgrade()
+        Model._clear_source_models()
+        return state
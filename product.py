@@ -0,0 +1,70 @@
+# This file is part of subscription module of Tryton.
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from trytond.pool import Pool, PoolMeta
+
+__all__ = ['PriceList', 'PriceListLine', 'Template', 'Product']
+__metaclass__ = PoolMeta
+
+
+def _clear_sale_price_cache():
+    SubscriptionLine = Pool().get('training.subscription.line')
+    SubscriptionLine._sale_price_cache.clear()
+
+
+class PriceList:
+    __name__ = 'product.price_list'
+
+    @classmethod
+    def create(cls, vlist):
+        price_lists = super(PriceList, cls).create(vlist)
+        _clear_sale_price_cache()
+        return price_lists
+
+    @classmethod
+    def write(cls, price_lists, values):
+        super(PriceList, cls).write(price_lists, values)
+        _clear_sale_price_cache()
+
+    @classmethod
+    def delete(cls, price_lists):
+        super(PriceList, cls).delete(price_lists)
+        _clear_sale_price_cache()
+
+
+class PriceListLine:
+    __name__ = 'product.price_list.line'
+
+    @classmethod
+    def create(cls, vlist):
+        lines = super(PriceListLine, cls).create(vlist)
+        _clear_sale_price_cache()
+        return lines
+
+    @classmethod
+    def write(cls, lines, values):
+        super(PriceListLine, cls).write(lines, values)
+        _clear_sale_price_cache()
+
+    @classmethod
+    def delete(cls, lines):
+        super(PriceListLine, cls).delete(lines)
+        _clear_sale_price_cache()
+
+
+class Template:
+    __name__ = 'product.template'
+
+    @classmethod
+    def write(cls, templates, values):
+        super(Template, cls).write(templates, values)
+        _clear_sale_price_cache()
+
+
+class Product:
+    __name__ = 'product.product'
+
+    @classmethod
+    def write(cls, products, values):
+        super(Product, cls).write(products, values)
+        _clear_sale_price_cache()
@@ -0,0 +1,23 @@
+# This file is part of subscription module of Tryton.
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from trytond.pool import Pool, PoolMeta
+
+__all__ = ['User']
+__metaclass__ = PoolMeta
+
+
+class User:
+    __name__ = 'res.user'
+
+    @classmethod
+    def write(cls, users, values):
+        Configuration = Pool().get('training.configuration')
+        super(User, cls).write(users, values)
+        Configuration._values_cache.clear()
+
+    @classmethod
+    def delete(cls, users):
+        Configuration = Pool().get('training.configuration')
+        super(User, cls).delete(users)
+        Configuration._values_cache.clear()
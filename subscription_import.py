@@ -0,0 +1,353 @@
+# This file is part of subscription module of Tryton.
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+import csv
+import logging
+from cStringIO import StringIO
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+from itertools import groupby
+
+from sql import Null
+from trytond.exceptions import UserError
+from trytond.model import ModelView, fields
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+from trytond.wizard import Wizard, StateView, StateTransition, Button
+
+__all__ = ['ImportSubscriptionStart', 'ImportSubscriptionResult',
+    'ImportSubscription']
+
+# Number of CSV rows created and committed together
+IMPORT_CHUNK = 1000
+
+DATE_FORMATS = ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d')
+
+
+class ImportSubscriptionStart(ModelView):
+    'Import Subscriptions'
+    __name__ = 'training.subscription.import.start'
+
+    data = fields.Binary('File', required=True,
+        help='CSV file with one line per student and session and the '
+            'columns:\nsubscriptor, student, session, quantity, '
+            'payment_term, price_list, date, next_call, number_calls, '
+            'description.\nConsecutive lines of the same subscriptor, '
+            'student, payment term and price list make one subscription.\n'
+            'The rows are saved by chunks, so the chunks imported before '
+            'an error are kept.')
+
+
+class ImportSubscriptionResult(ModelView):
+    'Import Subscriptions'
+    __name__ = 'training.subscription.import.result'
+
+    subscriptions = fields.Integer('Subscriptions', readonly=True)
+    lines = fields.Integer('Lines', readonly=True)
+    errors = fields.Text('Errors', readonly=True)
+
+
+class ImportSubscription(Wizard):
+    'Import Subscriptions'
+    __name__ = 'training.subscription.import'
+
+    start = StateView('training.subscription.import.start',
+        'training_subscription.subscription_import_start_view_form', [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Import', 'import_', 'tryton-ok', default=True),
+            ])
+    import_ = StateTransition()
+    result = StateView('training.subscription.import.result',
+        'training_subscription.subscription_import_result_view_form', [
+            Button('Close', 'end', 'tryton-close', default=True),
+            ])
+
+    @classmethod
+    def __setup__(cls):
+        super(ImportSubscription, cls).__setup__()
+        cls._error_messages.update({
+                'unknown_party': 'Unknown party code "%s"',
+                'unknown_student': 'Unknown student with party code "%s"',
+                'unknown_session': 'Unknown open session "%s"',
+                'unknown_payment_term': 'Unknown payment term "%s"',
+                'unknown_price_list': 'Unknown price list "%s"',
+                'wrong_value': 'Wrong value "%s" for column "%s"',
+                })
+
+    def transition_import_(self):
+        # import_csv commits each chunk, so unlike other wizards the import
+        # is not undone if the transition fails afterwards. The upload is
+        # already in memory, only the parsing is done row by row.
+        subscriptions, lines, errors = self.import_csv(
+            StringIO(str(self.start.data)))
+        self.result.subscriptions = subscriptions
+        self.result.lines = lines
+        self.result.errors = '\n'.join('%s: %s' % e for e in errors)
+        return 'result'
+
+    def default_result(self, fields):
+        return {
+            'subscriptions': self.result.subscriptions,
+            'lines': self.result.lines,
+            'errors': self.result.errors,
+            }
+
+    @classmethod
+    def import_csv(cls, file_, chunk=IMPORT_CHUNK):
+        '''
+        Create the draft subscriptions of the CSV file_.
+        The rows are parsed as they are read from file_ and each chunk of
+        rows is committed on its own, which ends the current transaction.
+        Return the number of subscriptions and lines created and the list
+        of (row number, error message).
+        '''
+        indexes = cls._load_indexes()
+
+        subscriptions = lines = 0
+        errors = []
+        to_create = []
+        rows = enumerate(csv.DictReader(file_), 2)
+        for _, group in groupby(rows, key=lambda r: cls._get_key(r[1])):
+            group = list(group)
+            try:
+                to_create.append(cls._get_values(group, indexes))
+            except ValueError as exception:
+                errors.append((group[0][0], exception.args[0]))
+                continue
+            if sum(len(g) for _, _, g in to_create) >= chunk:
+                created, chunk_errors = cls._create_chunk(to_create)
+                subscriptions += created[0]
+                lines += created[1]
+                errors.extend(chunk_errors)
+                to_create = []
+        if to_create:
+            created, chunk_errors = cls._create_chunk(to_create)
+            subscriptions += created[0]
+            lines += created[1]
+            errors.extend(chunk_errors)
+        return subscriptions, lines, errors
+
+    @staticmethod
+    def _get_key(row):
+        return tuple((row.get(c) or '').strip() for c in ('subscriptor',
+                'student', 'payment_term', 'price_list'))
+
+    @classmethod
+    def _load_indexes(cls):
+        '''
+        Return the dictionaries resolving the CSV values into ids
+        '''
+        pool = Pool()
+        Party = pool.get('party.party')
+        Student = pool.get('training.student')
+        Session = pool.get('training.session')
+        Offer = pool.get('training.offer')
+        Template = pool.get('product.template')
+        Product = pool.get('product.product')
+        PaymentTerm = pool.get('account.invoice.payment_term')
+        PriceList = pool.get('product.price_list')
+        party = Party.__table__()
+        student = Student.__table__()
+        session = Session.__table__()
+        offer = Offer.__table__()
+        template = Template.__table__()
+        product = Product.__table__()
+        payment_term = PaymentTerm.__table__()
+        price_list = PriceList.__table__()
+        cursor = Transaction().cursor
+        company = Transaction().context.get('company')
+
+        indexes = {}
+        cursor.execute(*party.select(party.code, party.id,
+                where=party.code != Null))
+        indexes['party'] = dict(cursor.fetchall())
+        cursor.execute(*student.join(party,
+                condition=student.name == party.id
+                ).select(party.code, student.id,
+                where=party.code != Null))
+        indexes['student'] = dict(cursor.fetchall())
+        cursor.execute(*session.join(offer,
+                condition=session.offer == offer.id
+                ).join(template, condition=offer.name == template.id
+                ).join(product, condition=product.template == template.id
+                ).select(session.name, session.id, product.id,
+                template.sale_uom, offer.number_calls,
+                where=session.state == 'open',
+                order_by=product.id))
+        indexes['session'] = dict((r[0], r[1:]) for r in cursor.fetchall())
+        cursor.execute(*payment_term.select(payment_term.name,
+                payment_term.id, where=payment_term.active == True))
+        indexes['payment_term'] = dict(cursor.fetchall())
+        cursor.execute(*price_list.select(price_list.name, price_list.id,
+                where=price_list.company == company))
+        indexes['price_list'] = dict(cursor.fetchall())
+        return indexes
+
+    @classmethod
+    def _lookup(cls, indexes, name, value, error):
+        try:
+            return indexes[name][value]
+        except KeyError:
+            raise ValueError(cls.raise_user_error(error, value,
+                    raise_exception=False))
+
+    @classmethod
+    def _parse(cls, parser, row, column, default=None):
+        value = (row.get(column) or '').strip()
+        if not value:
+            return default
+        try:
+            return parser(value)
+        except (ValueError, InvalidOperation):
+            raise ValueError(cls.raise_user_error('wrong_value',
+                    (value, column), raise_exception=False))
+
+    @staticmethod
+    def _parse_datetime(value):
+        for format_ in DATE_FORMATS:
+            try:
+                return datetime.strptime(value, format_)
+            except ValueError:
+                continue
+        raise ValueError(value)
+
+    @classmethod
+    def _get_values(cls, group, indexes):
+        '''
+        Return (row number, subscription values, lines values) for the
+        group of (row number, row)
+        '''
+        number, row = group[0]
+        subscriptor, student, payment_term, price_list = cls._get_key(row)
+        values = {
+            'subscriptor': cls._lookup(indexes, 'party', subscriptor,
+                'unknown_party'),
+            'student': cls._lookup(indexes, 'student', student or subscriptor,
+                'unknown_student'),
+            'payment_term': cls._lookup(indexes, 'payment_term',
+                payment_term, 'unknown_payment_term'),
+            'price_list': (cls._lookup(indexes, 'price_list', price_list,
+                    'unknown_price_list') if price_list else None),
+            'description': (row.get('description') or '').strip() or None,
+            }
+        date_ = cls._parse(cls._parse_datetime, row, 'date')
+        if date_:
+            values['date'] = date_.date()
+        next_call = cls._parse(cls._parse_datetime, row, 'next_call')
+        if next_call:
+            values['next_call'] = next_call
+
+        lines = []
+        number_calls = None
+        for number, row in group:
+            session = (row.get('session') or '').strip()
+            session_id, product_id, uom_id, offer_calls = cls._lookup(
+                indexes, 'session', session, 'unknown_session')
+            number_calls = cls._parse(int, row, 'number_calls',
+                number_calls or offer_calls)
+            lines.append({
+                    'session': session_id,
+                    'product': product_id,
+                    'uom': uom_id,
+                    'quantity': cls._parse(Decimal, row, 'quantity',
+                        Decimal(1)),
+                    'number_calls': number_calls,
+                    })
+        if number_calls:
+            values['number_calls'] = number_calls
+        return group[0][0], values, lines
+
+    @classmethod
+    def _create_chunk(cls, to_create):
+        '''
+        Create and commit the subscriptions of to_create.
+        If the chunk fails, each subscription is created on its own to
+        report the failing rows.
+        Return the number of subscriptions and lines created and the errors.
+        '''
+        cursor = Transaction().cursor
+        logger = logging.getLogger('training_subscription')
+        try:
+            created = cls._create_subscriptions(to_create)
+            cursor.commit()
+            return created, []
+        except Exception:
+            cursor.rollback()
+
+        subscriptions = lines = 0
+        errors = []
+        for values in to_create:
+            try:
+                created = cls._create_subscriptions([values])
+                cursor.commit()
+            except Exception as exception:
+                cursor.rollback()
+                logger.debug('Error importing row %s' % values[0],
+                    exc_info=True)
+                errors.append((values[0], cls._get_error(exception)))
+                continue
+            subscriptions += created[0]
+            lines += created[1]
+        return (subscriptions, lines), errors
+
+    @staticmethod
+    def _get_error(exception):
+        '''
+        Return the message of the exception
+        '''
+        # The args of UserError are ('UserError', (message, description))
+        if isinstance(exception, UserError):
+            return exception.message
+        return (exception.args or [''])[0]
+
+    @classmethod
+    def _create_subscriptions(cls, to_create):
+        '''
+        Create the subscriptions and their priced lines with one create
+        per model
+        '''
+        pool = Pool()
+        Subscription = pool.get('training.subscription')
+        Line = pool.get('training.subscription.line')
+        Product = pool.get('product.product')
+
+        subscriptions = Subscription.create([v for _, v, _ in to_create])
+
+        products = dict((p.id, p) for p in Product.browse(list(set(
+                        l['product'] for _, _, lines in to_create
+                        for l in lines))))
+        requests = []
+        for subscription, (_, _, lines) in zip(subscriptions, to_create):
+            context = {
+                'subscriptor': subscription.subscriptor.id,
+                }
+            if subscription.currency:
+                context['currency'] = subscription.currency.id
+            if subscription.date:
+                context['date'] = subscription.date
+            if subscription.price_list:
+                context['price_list'] = subscription.price_list.id
+            for line in lines:
+                line_context = context.copy()
+                line_context['uom'] = line['uom']
+                requests.append((products[line['product']], line['quantity'],
+                        line_context))
+        prices = iter(Line.get_sale_prices(requests))
+
+        digits = Line.unit_price.digits[1]
+        vlist = []
+        for subscription, (_, _, lines) in zip(subscriptions, to_create):
+            for line in lines:
+                price = prices.next()
+                if price:
+                    price = price.quantize(Decimal(1) / 10 ** digits)
+                vlist.append({
+                        'subscription': subscription.id,
+                        'session': line['session'],
+                        'uom': line['uom'],
+                        'quantity': line['quantity'],
+                        'unit_price': price,
+                        'number_calls': line['number_calls'],
+                        })
+        Line.create(vlist)
+        return len(subscriptions), len(vlist)
@@ -0,0 +1,331 @@
+#!/usr/bin/env python
+# This file is part of subscription module of Tryton.
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+'''
+Benchmark of the subscription billing lifecycle.
+
+Run against the test database (in-memory SQLite by default):
+
+    python benchmark_training_subscription.py --scale 1000 --scale 10000 \
+        --output bench_output.txt
+
+Each timed phase is written as one JSON line so runs can be compared.
+'''
+import sys
+import os
+DIR = os.path.abspath(os.path.normpath(os.path.join(__file__,
+    '..', '..', '..', '..', '..', 'trytond')))
+if os.path.isdir(DIR):
+    sys.path.insert(0, os.path.dirname(DIR))
+
+import datetime
+import json
+import optparse
+import time
+from decimal import Decimal
+
+import trytond.tests.test_tryton
+from trytond.tests.test_tryton import POOL, DB_NAME, USER, CONTEXT
+from trytond import backend
+from trytond.transaction import Transaction
+
+MODULE = 'training_subscription'
+SCALES = (1000, 10000, 100000)
+# Number of subscriptions per session
+SESSION_SIZE = 20
+
+
+class Benchmark(object):
+    '''
+    Generate synthetic data and time the phases of the lifecycle
+    '''
+
+    def __init__(self, scale, output):
+        self.scale = scale
+        self.output = output
+        self.results = []
+
+    def time(self, phase, function, *args):
+        start = time.time()
+        result = function(*args)
+        seconds = time.time() - start
+        if isinstance(result, list):
+            count = len(result)
+        elif args and isinstance(args[0], list):
+            count = len(args[0])
+        else:
+            count = 1
+        row = {
+            'phase': phase,
+            'scale': self.scale,
+            'records': count,
+            'seconds': round(seconds, 6),
+            'per_record_ms': round(seconds * 1000. / (count or 1), 6),
+            'backend': backend.name(),
+            'date': datetime.datetime.now().isoformat(),
+            }
+        self.results.append(row)
+        self.output.write(json.dumps(row, sort_keys=True) + '\n')
+        self.output.flush()
+        return result
+
+    def run(self):
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            try:
+                company = self.create_company()
+                with Transaction().set_context(company=company.id):
+                    self.create_accounting(company)
+                    sessions = self.time('create_sessions',
+                        self.create_sessions,
+                        max(self.scale // SESSION_SIZE, 1))
+                    students = self.time('create_students',
+                        self.create_students, self.scale)
+                    subscriptions = self.time('create_subscriptions',
+                        self.create_subscriptions, company, students,
+                        sessions)
+                    self.lifecycle(subscriptions, sessions)
+            finally:
+                Transaction().cursor.rollback()
+        return self.results
+
+    def lifecycle(self, subscriptions, sessions):
+        Subscription = POOL.get('training.subscription')
+        Session = POOL.get('training.session')
+
+        ids = [s.id for s in subscriptions]
+        self.time('total_amount', Subscription.read, ids, ['total_amount'])
+        self.time('count_subscriptions', Session.read,
+            [s.id for s in sessions], ['count_subscriptions'])
+        self.time('quotation', Subscription.quotation,
+            Subscription.browse(ids))
+        self.time('confirmed', Subscription.confirmed,
+            Subscription.browse(ids))
+        self.time('processing', Subscription.processing,
+            Subscription.browse(ids))
+        self.time('model_copy', self.model_copy, Subscription.browse(ids))
+        self.time('count_subscriptions_confirmed', Session.read,
+            [s.id for s in sessions], ['count_subscriptions'])
+        self.explain()
+
+    def model_copy(self, subscriptions):
+        Subscription = POOL.get('training.subscription')
+        for subscription in subscriptions:
+            Subscription.model_copy(subscription.id)
+
+    def explain(self):
+        '''
+        Write the query plans of the scheduler and list queries
+        '''
+        Subscription = POOL.get('training.subscription')
+        Occurrence = POOL.get('training.subscription.occurrence')
+        Line = POOL.get('training.subscription.line')
+        History = POOL.get('training.subscription.history')
+        subscription = Subscription.__table__()
+        occurrence = Occurrence.__table__()
+        line = Line.__table__()
+        history = History.__table__()
+        cursor = Transaction().cursor
+        now = datetime.datetime.now()
+
+        queries = {
+            'due_occurrences': occurrence.select(occurrence.subscription,
+                where=(occurrence.state == 'pending')
+                & (occurrence.run_at <= now)),
+            'due_subscriptions': subscription.select(subscription.id,
+                where=(subscription.state == 'processing')
+                & (subscription.next_due <= now)),
+            'company_list': subscription.select(subscription.id,
+                where=(subscription.company == 1)
+                & (subscription.state == 'processing')
+                & (subscription.active == True)),
+            'session_lines': line.select(line.id,
+                where=line.session == 1),
+            'session_subscriptions': line.select(line.subscription,
+                where=line.session == 1),
+            'subscription_history': history.select(history.id,
+                where=history.subscription == 1),
+            }
+        explain = ('EXPLAIN QUERY PLAN ' if backend.name() == 'sqlite'
+            else 'EXPLAIN ')
+        for name, query in sorted(queries.iteritems()):
+            query, params = tuple(query)
+            cursor.execute(explain + query, params)
+            row = {
+                'phase': 'plan_' + name,
+                'scale': self.scale,
+                'plan': [' '.join(str(c) for c in r)
+                    for r in cursor.fetchall()],
+                'backend': backend.name(),
+                }
+            self.results.append(row)
+            self.output.write(json.dumps(row, sort_keys=True) + '\n')
+
+    def create_company(self):
+        Currency = POOL.get('currency.currency')
+        Party = POOL.get('party.party')
+        Company = POOL.get('company.company')
+        User = POOL.get('res.user')
+
+        currency, = Currency.create([{
+                    'name': 'Benchmark Dollar',
+                    'code': 'BDL',
+                    'symbol': '$',
+                    }])
+        party, = Party.create([{
+                    'name': 'Benchmark Company',
+                    }])
+        company, = Company.create([{
+                    'party': party.id,
+                    'currency': currency.id,
+                    }])
+        User.write([User(USER)], {
+                'main_company': company.id,
+                'company': company.id,
+                })
+        return company
+
+    def create_accounting(self, company):
+        pool = POOL
+        AccountTemplate = pool.get('account.account.template')
+        Account = pool.get('account.account')
+        CreateChart = pool.get('account.create_chart', type='wizard')
+        Sequence = pool.get('ir.sequence')
+        SequenceStrict = pool.get('ir.sequence.strict')
+        FiscalYear = pool.get('account.fiscalyear')
+        PaymentTerm = pool.get('account.invoice.payment_term')
+
+        account_template, = AccountTemplate.search([
+                ('parent', '=', None),
+                ])
+        session_id, _, _ = CreateChart.create()
+        create_chart = CreateChart(session_id)
+        create_chart.account.account_template = account_template
+        create_chart.account.company = company
+        create_chart.transition_create_account()
+        receivable, = Account.search([
+                ('kind', '=', 'receivable'),
+                ('company', '=', company.id),
+                ])
+        payable, = Account.search([
+                ('kind', '=', 'payable'),
+                ('company', '=', company.id),
+                ])
+        create_chart.properties.company = company
+        create_chart.properties.account_receivable = receivable
+        create_chart.properties.account_payable = payable
+        create_chart.transition_create_properties()
+
+        year = datetime.date.today().year
+        post_move_sequence, = Sequence.create([{
+                    'name': '%s' % year,
+                    'code': 'account.move',
+                    'company': company.id,
+                    }])
+        invoice_sequence, = SequenceStrict.create([{
+                    'name': '%s' % year,
+                    'code': 'account.invoice',
+                    'company': company.id,
+                    }])
+        fiscalyear, = FiscalYear.create([{
+                    'name': '%s' % year,
+                    'start_date': datetime.date(year, 1, 1),
+                    'end_date': datetime.date(year + 1, 12, 31),
+                    'company': company.id,
+                    'post_move_sequence': post_move_sequence.id,
+                    'out_invoice_sequence': invoice_sequence.id,
+                    'in_invoice_sequence': invoice_sequence.id,
+                    'out_credit_note_sequence': invoice_sequence.id,
+                    'in_credit_note_sequence': invoice_sequence.id,
+                    }])
+        FiscalYear.create_period([fiscalyear])
+        self.payment_term, = PaymentTerm.create([{
+                    'name': 'Direct',
+                    'lines': [('create', [{'type': 'remainder'}])],
+                    }])
+        self.revenue, = Account.search([
+                ('kind', '=', 'revenue'),
+                ('company', '=', company.id),
+                ])
+
+    def create_sessions(self, count):
+        Uom = POOL.get('product.uom')
+        Template = POOL.get('product.template')
+        Offer = POOL.get('training.offer')
+        Session = POOL.get('training.session')
+
+        unit, = Uom.search([('name', '=', 'Unit')])
+        template, = Template.create([{
+                    'name': 'Benchmark Course',
+                    'type': 'service',
+                    'list_price': Decimal('100'),
+                    'cost_price': Decimal('0'),
+                    'default_uom': unit.id,
+                    'salable': True,
+                    'sale_uom': unit.id,
+                    'account_revenue': self.revenue.id,
+                    'products': [('create', [{}])],
+                    }])
+        offer, = Offer.create([{
+                    'name': template.id,
+                    'number_calls': 12,
+                    'interval_number': 1,
+                    }])
+        return Session.create([{
+                    'name': 'Session %s' % i,
+                    'offer': offer.id,
+                    'state': 'open',
+                    } for i in range(count)])
+
+    def create_students(self, count):
+        Party = POOL.get('party.party')
+        Student = POOL.get('training.student')
+
+        parties = Party.create([{
+                    'name': 'Student %s' % i,
+                    'is_person': True,
+                    } for i in range(count)])
+        return Student.create([{
+                    'name': p.id,
+                    } for p in parties])
+
+    def create_subscriptions(self, company, students, sessions):
+        Subscription = POOL.get('training.subscription')
+
+        now = datetime.datetime.now()
+        return Subscription.create([{
+                    'company': company.id,
+                    'subscriptor': student.name.id,
+                    'student': student.id,
+                    'payment_term': self.payment_term.id,
+                    'number_calls': 12,
+                    'next_call': now,
+                    'lines': [('create', [{
+                                    'session': sessions[
+                                        i // SESSION_SIZE % len(sessions)].id,
+                                    'quantity': Decimal(1),
+                                    'unit_price': Decimal('100'),
+                                    }])],
+                    } for i, student in enumerate(students)])
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--scale', dest='scales', action='append', type='int',
+        help='number of subscriptions, can be repeated (default: %s)'
+        % ', '.join(map(str, SCALES)))
+    parser.add_option('--output', dest='output',
+        help='file to append the JSON lines to (default: stdout)')
+    options, _ = parser.parse_args()
+
+    trytond.tests.test_tryton.install_module(MODULE)
+    output = open(options.output, 'a') if options.output else sys.stdout
+    try:
+        for scale in options.scales or SCALES:
+            Benchmark(scale, output).run()
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+if __name__ == '__main__':
+    main()
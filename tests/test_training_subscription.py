@@ -11,8 +11,16 @@ if os.path.isdir(DIR):
     sys.path.insert(0, os.path.dirname(DIR))
 
 import unittest
+import datetime
+from cStringIO import StringIO
+from decimal import Decimal
+from dateutil.relativedelta import relativedelta
+
 import trytond.tests.test_tryton
 from trytond.tests.test_tryton import test_view, test_depends
+from trytond.tests.test_tryton import POOL, DB_NAME, USER, CONTEXT
+from trytond.exceptions import UserError
+from trytond.transaction import Transaction
 
 
 class SubscriptionTestCase(unittest.TestCase):
@@ -21,13 +29,17 @@ class SubscriptionTestCase(unittest.TestCase):
     '''
 
     def setUp(self):
-        trytond.tests.test_tryton.install_module('subscription')
+        trytond.tests.test_tryton.install_module('training_subscription')
+        self.configuration = POOL.get('training.configuration')
+        self.subscription = POOL.get('training.subscription')
+        self.session = POOL.get('training.session')
+        self.queue = POOL.get('training.subscription.queue')
 
     def test0005views(self):
         '''
         Test views.
         '''
-        test_view('subscription')
+        test_view('training_subscription')
 
     def test0006depends(self):
         '''
@@ -35,6 +47,654 @@ class SubscriptionTestCase(unittest.TestCase):
         '''
         test_depends()
 
+    def create_company(self):
+        Currency = POOL.get('currency.currency')
+        Party = POOL.get('party.party')
+        Company = POOL.get('company.company')
+        User = POOL.get('res.user')
+
+        currency, = Currency.create([{
+                    'name': 'Test Dollar',
+                    'code': 'TDL',
+                    'symbol': '$',
+                    }])
+        party, = Party.create([{
+                    'name': 'Test Company',
+                    }])
+        company, = Company.create([{
+                    'party': party.id,
+                    'currency': currency.id,
+                    }])
+        User.write([User(USER)], {
+                'main_company': company.id,
+                'company': company.id,
+                })
+        self.create_sequence()
+        return company
+
+    def create_sequence(self):
+        '''
+        Create the subscription sequence which is not loaded in tests
+        '''
+        SequenceType = POOL.get('ir.sequence.type')
+        Sequence = POOL.get('ir.sequence')
+        Sequences = POOL.get('training.sequences')
+
+        SequenceType.create([{
+                    'name': 'Subscription',
+                    'code': 'training.subscription',
+                    }])
+        sequence, = Sequence.create([{
+                    'name': 'Subscription',
+                    'code': 'training.subscription',
+                    'prefix': 'SU',
+                    'padding': 5,
+                    }])
+        Sequences.write([Sequences(1)], {
+                'subscription_sequence': sequence.id,
+                })
+        return sequence
+
+    def create_accounting(self, company):
+        '''
+        Create the chart of accounts and the fiscal year needed to post the
+        invoices. Return the revenue account.
+        '''
+        AccountTemplate = POOL.get('account.account.template')
+        Account = POOL.get('account.account')
+        CreateChart = POOL.get('account.create_chart', type='wizard')
+        Sequence = POOL.get('ir.sequence')
+        SequenceStrict = POOL.get('ir.sequence.strict')
+        FiscalYear = POOL.get('account.fiscalyear')
+
+        account_template, = AccountTemplate.search([
+                ('parent', '=', None),
+                ])
+        session_id, _, _ = CreateChart.create()
+        create_chart = CreateChart(session_id)
+        create_chart.account.account_template = account_template
+        create_chart.account.company = company
+        create_chart.transition_create_account()
+        receivable, = Account.search([
+                ('kind', '=', 'receivable'),
+                ('company', '=', company.id),
+                ])
+        payable, = Account.search([
+                ('kind', '=', 'payable'),
+                ('company', '=', company.id),
+                ])
+        create_chart.properties.company = company
+        create_chart.properties.account_receivable = receivable
+        create_chart.properties.account_payable = payable
+        create_chart.transition_create_properties()
+
+        # The occurrences may be billed in the previous year
+        year = datetime.date.today().year - 1
+        post_move_sequence, = Sequence.create([{
+                    'name': '%s' % year,
+                    'code': 'account.move',
+                    'company': company.id,
+                    }])
+        invoice_sequence, = SequenceStrict.create([{
+                    'name': '%s' % year,
+                    'code': 'account.invoice',
+                    'company': company.id,
+                    }])
+        fiscalyear, = FiscalYear.create([{
+                    'name': '%s' % year,
+                    'start_date': datetime.date(year, 1, 1),
+                    'end_date': datetime.date(year + 2, 12, 31),
+                    'company': company.id,
+                    'post_move_sequence': post_move_sequence.id,
+                    'out_invoice_sequence': invoice_sequence.id,
+                    'in_invoice_sequence': invoice_sequence.id,
+                    'out_credit_note_sequence': invoice_sequence.id,
+                    'in_credit_note_sequence': invoice_sequence.id,
+                    }])
+        FiscalYear.create_period([fiscalyear])
+        revenue, = Account.search([
+                ('kind', '=', 'revenue'),
+                ('company', '=', company.id),
+                ])
+        return revenue
+
+    def create_session(self, capacity=None, revenue=None, name='Session'):
+        Uom = POOL.get('product.uom')
+        Template = POOL.get('product.template')
+        Offer = POOL.get('training.offer')
+
+        unit, = Uom.search([('name', '=', 'Unit')])
+        template, = Template.create([{
+                    'name': 'Course %s' % name,
+                    'type': 'service',
+                    'list_price': Decimal('100'),
+                    'cost_price': Decimal('0'),
+                    'default_uom': unit.id,
+                    'salable': True,
+                    'sale_uom': unit.id,
+                    'account_revenue': revenue.id if revenue else None,
+                    'products': [('create', [{}])],
+                    }])
+        offer, = Offer.create([{
+                    'name': template.id,
+                    'number_calls': 2,
+                    'interval_number': 1,
+                    }])
+        session, = self.session.create([{
+                    'name': name,
+                    'offer': offer.id,
+                    'state': 'open',
+                    'capacity': capacity,
+                    }])
+        return session
+
+    def create_payment_term(self):
+        PaymentTerm = POOL.get('account.invoice.payment_term')
+
+        payment_terms = PaymentTerm.search([('name', '=', 'Direct')])
+        if payment_terms:
+            return payment_terms[0]
+        payment_term, = PaymentTerm.create([{
+                    'name': 'Direct',
+                    'lines': [('create', [{'type': 'remainder'}])],
+                    }])
+        return payment_term
+
+    def create_students(self, count, prefix='S'):
+        Party = POOL.get('party.party')
+        Student = POOL.get('training.student')
+
+        parties = Party.create([{
+                    'name': 'Student %s' % i,
+                    'code': '%s%s' % (prefix, i),
+                    'is_person': True,
+                    'addresses': [('create', [{}])],
+                    } for i in range(count)])
+        return Student.create([{
+                    'name': p.id,
+                    } for p in parties])
+
+    def create_subscriptions(self, company, session, students, **values):
+        payment_term = self.create_payment_term()
+        vlist = []
+        for student in self.create_students(students):
+            vals = {
+                'company': company.id,
+                'subscriptor': student.name.id,
+                'student': student.id,
+                'payment_term': payment_term.id,
+                'number_calls': 2,
+                'next_call': datetime.datetime.now(),
+                'lines': [('create', [{
+                                'session': session.id,
+                                'quantity': Decimal(1),
+                                'unit_price': Decimal('100'),
+                                }])],
+                }
+            vals.update(values)
+            vlist.append(vals)
+        return self.subscription.create(vlist)
+
+    def confirm(self, subscriptions, confirmation='deferred'):
+        '''
+        Confirm the subscriptions, without creating their sales when the
+        confirmation is deferred
+        '''
+        self.configuration.write([self.configuration(1)], {
+                'confirmation': confirmation,
+                })
+        ids = [s.id for s in subscriptions]
+        self.subscription.quotation(self.subscription.browse(ids))
+        self.subscription.confirmed(self.subscription.browse(ids))
+        self.queue.write(self.queue.search([]), {'state': 'done'})
+        return self.subscription.browse(ids)
+
+    def bill(self, company, students, **values):
+        '''
+        Create and confirm subscriptions which create their sales and
+        invoices
+        '''
+        revenue = self.create_accounting(company)
+        session = self.create_session(revenue=revenue)
+        subscriptions = self.create_subscriptions(company, session,
+            students, **values)
+        return self.confirm(subscriptions, confirmation='immediate')
+
+    def process(self, subscriptions):
+        ids = [s.id for s in subscriptions]
+        self.subscription.processing(self.subscription.browse(ids))
+        return self.subscription.browse(ids)
+
+    def test0010seats(self):
+        '''
+        Test seats taken on confirmation and released on stop and done.
+        '''
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            company = self.create_company()
+            with Transaction().set_context(company=company.id):
+                session = self.create_session(capacity=5)
+                subscriptions = self.create_subscriptions(company, session,
+                    3)
+                self.assertEqual(self.session(session.id).seats_taken, 0)
+
+                subscriptions = self.confirm(subscriptions)
+                self.assertEqual(self.session(session.id).seats_taken, 3)
+                self.assertEqual(self.session(session.id).seats_available,
+                    2)
+
+                ids = [s.id for s in subscriptions]
+                self.subscription.processing(self.subscription.browse(ids))
+                self.assertEqual(self.session(session.id).seats_taken, 3)
+
+                self.subscription.stop(self.subscription.browse(ids[:1]))
+                self.assertEqual(self.session(session.id).seats_taken, 2)
+
+                self.subscription.processing(
+                    self.subscription.browse(ids[:1]))
+                self.assertEqual(self.session(session.id).seats_taken, 3)
+
+                self.subscription.done(self.subscription.browse(ids[1:]))
+                self.assertEqual(self.session(session.id).seats_taken, 1)
+
+    def test0015delete(self):
+        '''
+        Test deletion of the subscriptions holding seats.
+        '''
+        Line = POOL.get('training.subscription.line')
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            company = self.create_company()
+            with Transaction().set_context(company=company.id):
+                session = self.create_session(capacity=5)
+                confirmed, draft = self.create_subscriptions(company,
+                    session, 2)
+                confirmed, = self.confirm([confirmed])
+
+                self.assertRaises(UserError, self.subscription.delete,
+                    [confirmed])
+                self.assertRaises(UserError, Line.delete,
+                    list(confirmed.lines))
+                self.subscription.delete([draft])
+                self.assertEqual(self.session(session.id).seats_taken, 1)
+
+    def test0020session_full(self):
+        '''
+        Test confirmation over the capacity of the session.
+        '''
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            company = self.create_company()
+            with Transaction().set_context(company=company.id):
+                session = self.create_session(capacity=1)
+                first, second = self.create_subscriptions(company, session,
+                    2)
+
+                self.confirm([first])
+                self.assertEqual(self.session(session.id).seats_taken, 1)
+                with self.assertRaises(UserError) as cm:
+                    self.confirm([second])
+                self.assertIn('no seat left', cm.exception.message)
+
+    def test0030duplicate_enrollment(self):
+        '''
+        Test subscription of a student twice to the same session.
+        '''
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            company = self.create_company()
+            with Transaction().set_context(company=company.id):
+                session = self.create_session()
+                first, second = self.create_subscriptions(company, session,
+                    2)
+
+                self.assertRaises(UserError, self.subscription.copy,
+                    [first])
+                with self.assertRaises(UserError) as cm:
+                    self.subscription.write([second], {
+                            'student': first.student.id,
+                            })
+                self.assertIn('already subscribed', cm.exception.message)
+
+                self.subscription.cancel([first])
+                duplicate, = self.subscription.copy([first])
+                self.assertEqual(duplicate.student, first.student)
+
+    def test0040create_sales(self):
+        '''
+        Test the batched creation of the sales and invoices on confirmation.
+        '''
+        History = POOL.get('training.subscription.history')
+        Phase = POOL.get('training.subscription.history.phase')
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            company = self.create_company()
+            with Transaction().set_context(company=company.id):
+                subscriptions = self.bill(company, 3)
+
+                for subscription in subscriptions:
+                    sale, = subscription.sales
+                    self.assertEqual(subscription.model_source.id, sale.id)
+                    self.assertEqual(sale.party, subscription.student.name)
+                    self.assertEqual(sale.subscription_code,
+                        subscription.code)
+                    self.assertIn(sale.state, ['processing', 'done'])
+                    self.assertEqual(sale.untaxed_amount, Decimal('100'))
+                    invoice, = subscription.invoices
+                    self.assertEqual(invoice.state, 'posted')
+                    self.assertEqual(invoice.reference, subscription.code)
+                    self.assertEqual(invoice.invoice_date, sale.sale_date)
+                    history, = History.search([
+                            ('subscription', '=', subscription.id),
+                            ])
+                    self.assertTrue(history.success)
+
+                # The phases of the batch are stored once
+                phases = Phase.search([
+                        ('history.subscription', 'in',
+                            [s.id for s in subscriptions]),
+                        ])
+                self.assertTrue(phases)
+                self.assertEqual(len(set(p.history for p in phases)), 1)
+
+    def test0050occurrences(self):
+        '''
+        Test the materialization of the occurrences of the dispatcher.
+        '''
+        Occurrence = POOL.get('training.subscription.occurrence')
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            company = self.create_company()
+            with Transaction().set_context(company=company.id):
+                start = (datetime.datetime.now()
+                    + datetime.timedelta(days=1)).replace(microsecond=0)
+                subscription, = self.process(self.bill(company, 1,
+                        next_call=start, number_calls=3))
+
+                self.assertEqual(subscription.state, 'processing')
+                self.assertEqual(subscription.cron, None)
+                self.assertEqual(subscription.next_due, start)
+                self.assertEqual(subscription.remaining_calls, 3)
+                occurrences = Occurrence.search([
+                        ('subscription', '=', subscription.id),
+                        ], order=[('number', 'ASC')])
+                self.assertEqual([o.number for o in occurrences], [1, 2, 3])
+                self.assertEqual([o.due_date for o in occurrences],
+                    [start + relativedelta(months=i) for i in range(3)])
+                self.assertEqual([o.run_at for o in occurrences],
+                    [o.due_date for o in occurrences])
+                self.assertEqual(set(o.state for o in occurrences),
+                    set(['pending']))
+
+                # Nothing is due yet
+                self.subscription.dispatch()
+                subscription = self.subscription(subscription.id)
+                self.assertEqual(len(subscription.sales), 1)
+                self.assertEqual(Occurrence.search_count([
+                            ('subscription', '=', subscription.id),
+                            ('state', '=', 'pending'),
+                            ]), 3)
+
+    def test0060dispatch(self):
+        '''
+        Test the dispatcher bills each due occurrence once.
+        '''
+        Occurrence = POOL.get('training.subscription.occurrence')
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            company = self.create_company()
+            with Transaction().set_context(company=company.id):
+                start = (datetime.datetime.now()
+                    - datetime.timedelta(minutes=1)).replace(microsecond=0)
+                subscription, = self.process(self.bill(company, 1,
+                        next_call=start, number_calls=3))
+
+                self.subscription.dispatch()
+                subscription = self.subscription(subscription.id)
+                occurrences = Occurrence.search([
+                        ('subscription', '=', subscription.id),
+                        ], order=[('number', 'ASC')])
+                self.assertEqual([o.state for o in occurrences],
+                    ['done', 'pending', 'pending'])
+                first = occurrences[0]
+                self.assertEqual(first.document.__name__, 'sale.sale')
+                self.assertEqual(first.document.sale_date, start.date())
+                self.assertIn(first.document, subscription.sales)
+                self.assertEqual(len(subscription.sales), 2)
+                self.assertEqual(subscription.remaining_calls, 2)
+                self.assertEqual(subscription.next_due,
+                    occurrences[1].due_date)
+
+                # The billed occurrence is not billed again
+                self.subscription.dispatch()
+                subscription = self.subscription(subscription.id)
+                self.assertEqual(len(subscription.sales), 2)
+
+                # A failed billing is retried later, keeping its due date
+                second = occurrences[1]
+                now = datetime.datetime.now().replace(microsecond=0)
+                Occurrence.postpone([second])
+                second = Occurrence(second.id)
+                self.assertEqual(second.attempts, 1)
+                self.assertGreaterEqual(second.run_at,
+                    now + datetime.timedelta(minutes=5))
+                Occurrence.postpone([second])
+                second = Occurrence(second.id)
+                self.assertEqual(second.attempts, 2)
+                self.assertGreaterEqual(second.run_at,
+                    now + datetime.timedelta(minutes=10))
+                self.assertEqual(second.due_date, occurrences[1].due_date)
+
+    def test0070catch_up(self):
+        '''
+        Test the catch-up bills the missed occurrences only once.
+        '''
+        Occurrence = POOL.get('training.subscription.occurrence')
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            company = self.create_company()
+            with Transaction().set_context(company=company.id):
+                self.configuration.write([self.configuration(1)], {
+                        'catch_up': True,
+                        })
+                start = (datetime.datetime.now()
+                    - relativedelta(months=3, minutes=1)).replace(
+                    microsecond=0)
+                subscription, = self.process(self.bill(company, 1,
+                        next_call=start, number_calls=5))
+
+                self.subscription.dispatch()
+                subscription = self.subscription(subscription.id)
+                occurrences = Occurrence.search([
+                        ('subscription', '=', subscription.id),
+                        ], order=[('number', 'ASC')])
+                self.assertEqual([o.state for o in occurrences],
+                    ['done'] * 4 + ['pending'])
+                # Each missed occurrence is billed on its own period
+                for occurrence in occurrences[:4]:
+                    self.assertEqual(occurrence.document.sale_date,
+                        occurrence.due_date.date())
+                self.assertEqual(len(subscription.sales), 5)
+                self.assertEqual(subscription.remaining_calls, 1)
+                self.assertEqual(subscription.next_due,
+                    occurrences[4].due_date)
+
+                self.subscription.dispatch()
+                subscription = self.subscription(subscription.id)
+                self.assertEqual(len(subscription.sales), 5)
+                self.assertEqual(Occurrence.search_count([
+                            ('subscription', '=', subscription.id),
+                            ('state', '=', 'done'),
+                            ]), 4)
+
+    def test0080total_amount(self):
+        '''
+        Test the totals computed in SQL.
+        '''
+        Line = POOL.get('training.subscription.line')
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            company = self.create_company()
+            with Transaction().set_context(company=company.id):
+                session = self.create_session()
+                other_session = self.create_session(name='Other')
+                first, second = self.create_subscriptions(company, session, 2)
+                Line.write(list(first.lines), {'quantity': Decimal(2)})
+                Line.create([{
+                            'subscription': first.id,
+                            'session': other_session.id,
+                            'quantity': Decimal(1),
+                            'unit_price': Decimal('50.5'),
+                            }])
+                student, = self.create_students(1, prefix='E')
+                empty, = self.subscription.create([{
+                            'company': company.id,
+                            'subscriptor': student.name.id,
+                            'student': student.id,
+                            }])
+                subscriptions = self.subscription.browse(
+                    [first.id, second.id, empty.id])
+                ids = [s.id for s in subscriptions]
+
+                self.assertEqual([s.total_amount for s in subscriptions],
+                    [Decimal('250.5'), Decimal('100'), Decimal('0')])
+                for subscription in subscriptions:
+                    self.assertEqual(subscription.total_amount,
+                        sum((l.quantity * l.unit_price
+                                for l in subscription.lines), Decimal(0)))
+                    for line in subscription.lines:
+                        self.assertEqual(line.total_amount,
+                            line.quantity * line.unit_price)
+
+                def search(operator, value):
+                    return self.subscription.search([
+                            ('id', 'in', ids),
+                            ('total_amount', operator, value),
+                            ])
+                self.assertEqual(search('in', []), [])
+                self.assertEqual(search('in', [None]), [])
+                self.assertEqual(search('=', None), [])
+                self.assertEqual(len(search('!=', None)), 3)
+                self.assertEqual(len(search('not in', [])), 3)
+                self.assertEqual(Line.search([
+                            ('subscription', 'in', ids),
+                            ('total_amount', '=', None),
+                            ]), [])
+
+                self.assertEqual(self.subscription.search([
+                            ('id', 'in', ids),
+                            ], order=[('total_amount', 'ASC')]),
+                    [empty, second, first])
+
+                self.assertRaises(UserError,
+                    self.subscription.search_total_amount, 'total_amount',
+                    ('total_amount', 'child_of', [1]))
+
+    def test0090codes(self):
+        '''
+        Test the codes of a batch have no gap and no duplicate.
+        '''
+        Sequence = POOL.get('ir.sequence')
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            company = self.create_company()
+            with Transaction().set_context(company=company.id):
+                session = self.create_session()
+                subscriptions = self.create_subscriptions(company, session, 4)
+                ids = [s.id for s in subscriptions]
+
+                self.subscription.quotation(
+                    self.subscription.browse(ids[:3]))
+                self.assertEqual(sorted(s.code
+                        for s in self.subscription.browse(ids[:3])),
+                    ['SU00001', 'SU00002', 'SU00003'])
+
+                self.subscription.quotation(
+                    self.subscription.browse(ids[3:]))
+                self.assertEqual(self.subscription(ids[3]).code, 'SU00004')
+                sequence, = Sequence.search([
+                        ('code', '=', 'training.subscription'),
+                        ])
+                self.assertEqual(sequence.number_next, 5)
+
+    def test0100queue(self):
+        '''
+        Test the retries of the deferred confirmation.
+        '''
+        History = POOL.get('training.subscription.history')
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            company = self.create_company()
+            with Transaction().set_context(company=company.id):
+                session = self.create_session()
+                subscription, = self.create_subscriptions(company, session, 1)
+                self.configuration.write([self.configuration(1)], {
+                        'confirmation': 'deferred',
+                        })
+                self.subscription.quotation([subscription])
+                self.subscription.confirmed([subscription])
+                job, = self.queue.search([
+                        ('subscription', '=', subscription.id),
+                        ])
+                self.assertEqual(job.state, 'pending')
+                self.assertEqual(job.attempts, 0)
+
+                # The schedule waits for the sales
+                self.assertRaises(UserError, self.subscription.processing,
+                    [self.subscription(subscription.id)])
+
+                error = 'Traceback\nValueError: boom\n'
+                for attempt in range(1, 5):
+                    now = datetime.datetime.now().replace(microsecond=0)
+                    self.queue._fail(job, error)
+                    job = self.queue(job.id)
+                    self.assertEqual(job.state, 'pending')
+                    self.assertEqual(job.attempts, attempt)
+                    self.assertEqual(job.error, error)
+                    delay = datetime.timedelta(minutes=5) * 2 ** (attempt - 1)
+                    self.assertGreaterEqual(job.next_try, now + delay)
+
+                self.queue._fail(job, error)
+                job = self.queue(job.id)
+                self.assertEqual(job.state, 'failed')
+                self.assertEqual(job.attempts, 5)
+                histories = History.search([
+                        ('subscription', '=', subscription.id),
+                        ])
+                self.assertEqual(len(histories), 5)
+                for history in histories:
+                    self.assertFalse(history.success)
+                    self.assertIn('boom', history.log)
+
+                self.queue.requeue([job])
+                job = self.queue(job.id)
+                self.assertEqual(job.state, 'pending')
+                self.assertEqual(job.attempts, 0)
+
+    def test0110import_errors(self):
+        '''
+        Test the import reports the rows in error.
+        '''
+        ImportSubscription = POOL.get('training.subscription.import',
+            type='wizard')
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            company = self.create_company()
+            with Transaction().set_context(company=company.id):
+                self.create_session()
+                self.create_payment_term()
+                self.create_students(2)
+
+                # Only rows in error so nothing is committed
+                data = '\n'.join([
+                        'subscriptor,payment_term,session,quantity',
+                        'X,Direct,Session,1',
+                        'S0,Direct,Unknown,1',
+                        'S1,Direct,Session,abc',
+                        ]) + '\n'
+                subscriptions, lines, errors = ImportSubscription.import_csv(
+                    StringIO(data))
+                self.assertEqual((subscriptions, lines), (0, 0))
+                self.assertEqual(errors, [
+                        (2, 'Unknown party code "X"'),
+                        (3, 'Unknown open session "Unknown"'),
+                        (4, 'Wrong value "abc" for column "quantity"'),
+                        ])
+                self.assertEqual(self.subscription.search([]), [])
+
+        self.assertEqual(ImportSubscription._get_error(UserError('Error')),
+            'Error')
+        self.assertEqual(ImportSubscription._get_error(ValueError('Error')),
+            'Error')
+
 def suite():
     suite = trytond.tests.test_tryton.suite()
     suite.addTests(unittest.TestLoader().loadTestsFromTestCase(
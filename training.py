@@ -1,16 +1,77 @@
 #This file is part of Tryton.  The COPYRIGHT file at the top level of
 #this repository contains the full copyright notices and license terms.
+import math
+import time
+from contextlib import contextmanager
 from decimal import Decimal
-from datetime import datetime
+from datetime import datetime, timedelta
+from dateutil.relativedelta import relativedelta
+from sql import Table, Null, Literal, Cast
+from sql.aggregate import Avg, Count, Max, Min, Sum
+from sql.conditionals import Coalesce
+from sql.functions import CurrentTimestamp, Extract
+from sql.operators import (Equal, NotEqual, Less, LessEqual, Greater,
+    GreaterEqual, Like, NotLike, ILike, NotILike, In, NotIn)
+from trytond import backend
 from trytond.model import Workflow, ModelView, ModelSQL, fields
+from trytond.cache import Cache
 from trytond.modules.company import CompanyReport
 from trytond.pyson import If, Eval, PYSONEncoder, Date, Id
+from trytond.rpc import RPC
 from trytond.transaction import Transaction
 from trytond.pool import Pool, PoolMeta
+from trytond.wizard import Wizard, StateView, StateAction, Button
+import json
 import logging
+import subprocess
+import sys
+import traceback
 
 _ZERO = Decimal(0)
 
+_SQL_OPERATORS = {
+    '=': Equal,
+    '!=': NotEqual,
+    '<': Less,
+    '<=': LessEqual,
+    '>': Greater,
+    '>=': GreaterEqual,
+    'like': Like,
+    'not like': NotLike,
+    'ilike': ILike,
+    'not ilike': NotILike,
+    'in': In,
+    'not in': NotIn,
+    }
+
+
+def _get_sql_clause(column, operator, value):
+    '''
+    Return the SQL expression of the domain clause on column.
+    None is compared with IS NULL.
+    '''
+    if operator not in _SQL_OPERATORS:
+        Subscription = Pool().get('training.subscription')
+        Subscription.raise_user_error('unsupported_operator', operator)
+    Operator = _SQL_OPERATORS[operator]
+    if operator in ('in', 'not in'):
+        values = [v for v in value if v is not None]
+        if operator == 'in':
+            expression = Operator(column, values) if values else Literal(False)
+            if len(values) != len(value):
+                expression |= (column == Null)
+        else:
+            expression = Operator(column, values) if values else Literal(True)
+            if len(values) != len(value):
+                expression &= (column != Null)
+        return expression
+    if value is None:
+        if operator == '=':
+            return column == Null
+        elif operator == '!=':
+            return column != Null
+    return Operator(column, value)
+
 STATES = {
     'readonly': (Eval('state') != 'draft'),
 }
@@ -34,6 +95,30 @@ MEDIA = [
     ('llamada', 'Llamada')
     ]
 
+# Delay before the first retry of a failed queued confirmation
+QUEUE_RETRY_DELAY = timedelta(minutes=5)
+
+# Seconds during which the dashboard values are served from the cache
+DASHBOARD_TIMEOUT = 30
+
+# Subscription states which hold a seat on their sessions
+CONFIRMED_STATES = ['confirmed', 'processing']
+
+# Context keys of the sale price which may come from the transaction
+SALE_PRICE_CONTEXT = ['company', 'currency', 'price_list', 'customer',
+    'uom', 'date']
+
+PHASES = [
+    ('copy', 'Copy Document'),
+    ('sale_create', 'Create Sales'),
+    ('sale_search', 'Search Sales'),
+    ('sale_quote', 'Quote Sales'),
+    ('sale_confirm', 'Confirm Sales'),
+    ('sale_process', 'Process Sales'),
+    ('invoice_search', 'Search Invoices'),
+    ('invoice_post', 'Post Invoices'),
+    ]
+
 INVOICE = [
     ('by_subscriptor', 'By Subscriptor'),
     ('by_student', 'By Student')
@@ -42,6 +127,13 @@ INVOICE = [
 __all__ = ['TrainingSubscription', 'TrainingSubscriptionLine',
            'TrainingSubscriptionSale', 'TrainingSubscriptionInvoice',
            'TrainingSubscriptionHistory',
+           'TrainingSubscriptionHistoryPhase',
+           'TrainingSubscriptionPhaseStatistics',
+           'OpenPhaseStatisticsStart', 'OpenPhaseStatistics',
+           'TrainingSubscriptionForecast',
+           'OpenForecastStart', 'OpenForecast',
+           'TrainingSubscriptionOccurrence',
+           'TrainingSubscriptionQueue',
            'TrainingOffer',
            'Sale',
            'SubscriptionReport',
@@ -49,23 +141,66 @@ __all__ = ['TrainingSubscription', 'TrainingSubscriptionLine',
 
 __metaclass__ = PoolMeta
 
+
+class PhaseTimer(object):
+    '''
+    Measure the wall-clock time and the number of queries of phases
+    '''
+
+    def __init__(self):
+        self.values = []
+
+    @contextmanager
+    def phase(self, name):
+        '''
+        Count the queries of the phase by wrapping the execute method of
+        the cursor. The previous method is put back when the phase ends,
+        even on error, so nested phases restore the counting of their
+        parent.
+        '''
+        logger = logging.getLogger('training_subscription')
+        cursor = Transaction().cursor
+        previous = cursor.__dict__.get('execute')
+        execute = cursor.execute
+        queries = [0]
+
+        def counted_execute(*args, **kwargs):
+            queries[0] += 1
+            return execute(*args, **kwargs)
+
+        start = time.time()
+        try:
+            cursor.execute = counted_execute
+            yield
+        finally:
+            duration = time.time() - start
+            if previous is not None:
+                cursor.execute = previous
+            else:
+                cursor.__dict__.pop('execute', None)
+            self.values.append({
+                    'phase': name,
+                    'duration': duration,
+                    'queries': queries[0],
+                    })
+            logger.debug('phase %s: %.3fs, %s queries'
+                % (name, duration, queries[0]))
+
+    def get_values(self):
+        return list(self.values)
+
+
 class TrainingSubscription(Workflow, ModelView, ModelSQL):
     'Training Subscription'
     __name__ = 'training.subscription'
+    _billing_template_cache = Cache(
+        'training.subscription.billing_template', size_limit=10240)
+    _dashboard_cache = Cache('training.subscription.dashboard')
     
     @classmethod
     def get_model(cls):
-        cr = Transaction().cursor
-        cr.execute('''\
-            SELECT
-                m.model,
-                m.name
-            FROM
-                ir_model m
-            ORDER BY
-                m.name
-        ''')
-        return cr.fetchall()
+        Configuration = Pool().get('training.configuration')
+        return Configuration.get_source_models()
 
     company = fields.Many2One('company.company', 'Company', required=True,
         states={
@@ -92,7 +227,7 @@ class TrainingSubscription(Workflow, ModelView, ModelSQL):
                               required=True, 
                               states=STATES)
     student = fields.Many2One('training.student', 'Student', 
-                              required=True,
+                              required=True, select=True,
                               states=STATES)
     invoice_method = fields.Selection(INVOICE, 'Invoice Method',
         required=True, states=STATES)
@@ -111,7 +246,8 @@ class TrainingSubscription(Workflow, ModelView, ModelSQL):
                                     'Subscription Lines',
                                     on_change=['lines'],
                                     states=STATES)
-    session = fields.Function(fields.Char('Session'), 'get_session')
+    session = fields.Function(fields.Char('Session'), 'get_session',
+        searcher='search_session')
     price_list = fields.Many2One('product.price_list', 'Price List',
         domain=[('company', '=', Eval('company'))], 
         states=STATES)
@@ -136,7 +272,8 @@ class TrainingSubscription(Workflow, ModelView, ModelSQL):
                                                   readonly=True, 
                                                   states=STATES, 
                                                   depends=['lines']), 
-                                   'get_total_amount')
+                                   'get_total_amount',
+                                   searcher='search_total_amount')
     
     sales = fields.Many2Many('training.subscription-sale.sale', 
                              'subscription', 'sale', 'Sales',
@@ -167,6 +304,11 @@ class TrainingSubscription(Workflow, ModelView, ModelSQL):
     number_calls = fields.Integer('Number of documents', states=STATES)
     cron = fields.Many2One('ir.cron', 'Cron Job', states=STATES, 
             help='Scheduler which runs on subscription.', ondelete='CASCADE')
+    next_due = fields.DateTime('Next Due', readonly=True, select=True,
+        help='Next time the dispatcher bills the subscription.')
+    remaining_calls = fields.Integer('Remaining Documents', readonly=True)
+    occurrences = fields.One2Many('training.subscription.occurrence',
+        'subscription', 'Occurrences', readonly=True)
     
     model_source = fields.Reference('Source Document',
             selection='get_model', depends=['state'],
@@ -214,6 +356,9 @@ class TrainingSubscription(Workflow, ModelView, ModelSQL):
                     'invisible': Eval('state') != 'processing',
                     },
                 })
+        cls.__rpc__.update({
+                'get_dashboard': RPC(),
+                })
         cls._error_messages.update({
             'payterm_missing': ('The payment term is missing!'),
             'error': 'Error. Wrong Source Document',
@@ -222,8 +367,77 @@ class TrainingSubscription(Workflow, ModelView, ModelSQL):
             'error_creating': 'Error creating document \'%s\'',
             'created_successfully': 'Document \'%s\' created successfully',
             'invoice_missing': 'The invoice is missing',
+            'sales_created': '%s sales created',
+            'sales_failed': 'Error creating the sales (attempt %s): %s',
+            'sales_pending': ('The sales of subscription "%s" are not '
+                'created yet.'),
+            'session_full': 'The session "%s" has no seat left.',
+            'billing_failed': 'Error billing the subscription: %s',
+            'unsupported_operator': 'The operator "%s" is not supported.',
+            'delete_cancel': ('Subscription "%s" must be cancelled before '
+                'deletion.'),
+            'dashboard_company': ('The dashboard is only available for the '
+                'current company of the user.'),
             })
     
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().cursor
+        sql_table = cls.__table__()
+        cron = Table('ir_cron')
+
+        # Migration from one scheduler per subscription to the dispatcher
+        migrate_cron = False
+        if TableHandler.table_exist(cursor, cls._table):
+            table = TableHandler(cursor, cls, module_name)
+            migrate_cron = not table.column_exist('next_due')
+
+        super(TrainingSubscription, cls).__register__(module_name)
+
+        table = TableHandler(cursor, cls, module_name)
+        table.index_action(['company', 'state', 'active'], 'add')
+        table.index_action(['state', 'next_due'], 'add')
+
+        if migrate_cron:
+            processing = ((sql_table.state == 'processing')
+                & (sql_table.cron != Null))
+            cursor.execute(*cron.update(
+                    columns=[cron.active],
+                    values=[False],
+                    where=cron.id.in_(sql_table.select(sql_table.cron,
+                            where=processing))))
+            cursor.execute(*sql_table.update(
+                    columns=[sql_table.next_due, sql_table.remaining_calls,
+                        sql_table.cron],
+                    values=[
+                        cron.select(cron.next_call,
+                            where=cron.id == sql_table.cron),
+                        cron.select(cron.number_calls,
+                            where=cron.id == sql_table.cron),
+                        Null],
+                    where=processing))
+            # The stopped subscriptions keep their inactive scheduler but
+            # must resume from where it stopped
+            cursor.execute(*sql_table.update(
+                    columns=[sql_table.next_due, sql_table.remaining_calls],
+                    values=[
+                        cron.select(cron.next_call,
+                            where=cron.id == sql_table.cron),
+                        cron.select(cron.number_calls,
+                            where=cron.id == sql_table.cron)],
+                    where=(sql_table.state == 'stop')
+                    & (sql_table.cron != Null)))
+
+    @classmethod
+    def delete(cls, subscriptions):
+        # Only the subscriptions without seats taken can be deleted
+        for subscription in subscriptions:
+            if subscription.state not in ('draft', 'cancel'):
+                cls.raise_user_error('delete_cancel',
+                    subscription.rec_name)
+        super(TrainingSubscription, cls).delete(subscriptions)
+
     @classmethod
     def copy(cls, subscriptions, default=None):
         if default is None:
@@ -233,6 +447,10 @@ class TrainingSubscription(Workflow, ModelView, ModelSQL):
         default['code'] = None
         default['sales'] = None
         default['invoices'] = None
+        default['cron'] = None
+        default['next_due'] = None
+        default['remaining_calls'] = None
+        default['occurrences'] = None
         default.setdefault('date', None)
         return super(TrainingSubscription, cls).copy(subscriptions, default=default)
     
@@ -247,12 +465,8 @@ class TrainingSubscription(Workflow, ModelView, ModelSQL):
     
     @staticmethod
     def default_user():
-        User = Pool().get('res.user')
-        user_ids = User.search([
-                ('active', '=', False),
-                ('login', '=', 'user_cron_trigger'),
-            ])
-        return user_ids[0].id
+        Configuration = Pool().get('training.configuration')
+        return Configuration.get_cron_user()
     
     @staticmethod
     def default_next_call():
@@ -288,15 +502,23 @@ class TrainingSubscription(Workflow, ModelView, ModelSQL):
     
     @staticmethod
     def default_currency():
-        Company = Pool().get('company.company')
+        Configuration = Pool().get('training.configuration')
         company = Transaction().context.get('company')
         if company:
-            return Company(company).currency.id
+            return Configuration.get_company_currency(company)
     
     @staticmethod
     def default_model_source():
         return ('sale.sale', -1)
 
+    @classmethod
+    def validate(cls, subscriptions):
+        Line = Pool().get('training.subscription.line')
+        super(TrainingSubscription, cls).validate(subscriptions)
+        # The student of the subscription may have changed
+        Line.check_duplicate_enrollments([l for s in subscriptions
+                for l in s.lines])
+
     @classmethod
     @ModelView.button
     @Workflow.transition('cancel')
@@ -314,6 +536,9 @@ class TrainingSubscription(Workflow, ModelView, ModelSQL):
     @ModelView.button
     @Workflow.transition('quotation')
     def quotation(cls, subscriptions):
+        Line = Pool().get('training.subscription.line')
+        Line.check_duplicate_enrollments([l for s in subscriptions
+                for l in s.lines])
         cls.set_code(subscriptions)
 
     @classmethod
@@ -321,170 +546,286 @@ class TrainingSubscription(Workflow, ModelView, ModelSQL):
         '''
         Fill the code field with the sale sequence
         '''
+        to_code = [s for s in subscriptions if not s.code]
+        codes = cls._get_codes(len(to_code))
+        for subscription, code in zip(to_code, codes):
+            cls.write([subscription], {'code': code})
+
+    @classmethod
+    def _get_codes(cls, count):
+        '''
+        Reserve a block of count codes from the subscription sequence.
+        The block is taken with a single query from the SQL sequence of
+        PostgreSQL, otherwise each code is taken from the sequence.
+        '''
         pool = Pool()
         Sequence = pool.get('ir.sequence')
-        Config = Pool().get('training.sequences')
+        Configuration = pool.get('training.configuration')
+        cursor = Transaction().cursor
 
-        config = Config(1)
-        for subscription in subscriptions:
-            if subscription.code:
-                continue
-            code = Sequence.get_id(config.subscription_sequence.id)
-            cls.write([subscription], {
-                    'code': code,
-                    })
+        if not count:
+            return []
+        sequence_id = Configuration.get_subscription_sequence()
+        with Transaction().set_user(0):
+            sequence = Sequence(sequence_id)
+            # Only the non-strict incremental sequences use a SQL sequence
+            if (backend.name() != 'postgresql'
+                    or Sequence._strict
+                    or sequence.type != 'incremental'):
+                return [Sequence.get_id(sequence_id) for _ in range(count)]
+
+            # The SQL sequence does not lock the sequence row
+            cursor.execute('SELECT nextval(%s) '
+                'FROM generate_series(1, %s)',
+                (sequence._sql_sequence_name, count))
+            numbers = [n for n, in cursor.fetchall()]
+
+            prefix = Sequence._process(sequence.prefix)
+            suffix = Sequence._process(sequence.suffix)
+        return ['%s%s%s' % (prefix, '%%0%sd' % sequence.padding % n, suffix)
+            for n in numbers]
 
     @classmethod
     @ModelView.button
     @Workflow.transition('confirmed')
     def confirmed(cls, subscriptions):
-        for subscription in subscriptions:
-            cls._create_sale(subscription)
-    
+        pool = Pool()
+        Configuration = pool.get('training.configuration')
+        Queue = pool.get('training.subscription.queue')
+        Line = pool.get('training.subscription.line')
+        cls._update_seats(subscriptions, 1)
+        # Check again now that the session rows are locked by the seats
+        # update, so concurrent confirmations can not both pass
+        Line.check_duplicate_enrollments([l for s in subscriptions
+                for l in s.lines])
+        if Configuration(1).confirmation == 'deferred':
+            Queue.enqueue(subscriptions)
+        else:
+            cls._create_sales(subscriptions)
+
+    @classmethod
+    def _update_seats(cls, subscriptions, sign):
+        '''
+        Take (sign=1) or release (sign=-1) the seats of the subscription
+        lines on their sessions.
+        Each session row is updated in place so parallel confirmations
+        never overbook it.
+        '''
+        pool = Pool()
+        Line = pool.get('training.subscription.line')
+        Session = pool.get('training.session')
+        line = Line.__table__()
+        session = Session.__table__()
+        cursor = Transaction().cursor
+
+        ids = [s.id for s in subscriptions]
+        seats = {}
+        for i in range(0, len(ids), cursor.IN_MAX):
+            sub_ids = ids[i:i + cursor.IN_MAX]
+            cursor.execute(*line.select(line.session, Count(line.id),
+                    where=line.subscription.in_(sub_ids),
+                    group_by=line.session))
+            for session_id, count in cursor.fetchall():
+                seats[session_id] = seats.get(session_id, 0) + count
+
+        # Update the sessions always in the same order to avoid deadlocks
+        for session_id in sorted(seats):
+            count = seats[session_id] * sign
+            taken = Coalesce(session.seats_taken, 0) + count
+            where = session.id == session_id
+            if count > 0:
+                where &= ((session.capacity == Null)
+                    | (session.capacity <= 0)
+                    | (taken <= session.capacity))
+            cursor.execute(*session.update(
+                    columns=[session.seats_taken],
+                    values=[taken],
+                    where=where))
+            if not cursor.rowcount:
+                cls.raise_user_error('session_full',
+                    Session(session_id).rec_name)
+
     @classmethod
     def _create_sale(cls, subscription):
+        cls._create_sales([subscription])
+
+    @classmethod
+    def _get_sale_parties(cls, subscription):
+        '''
+        Return the list of (party, lines) to invoice for the subscription
+        '''
+        if subscription.invoice_method == 'by_subscriptor':
+            return [(subscription.subscriptor, subscription.lines)]
+        elif subscription.invoice_method == 'by_student':
+            return [(subscription.student.name, subscription.lines)]
+        return []
+
+    @classmethod
+    def _get_sale_vals(cls, subscription, party, code, date_):
+        Party = Pool().get('party.party')
+        return {
+            'company': subscription.company.id,
+            'payment_term': subscription.payment_term.id,
+            'subscription_code': code,
+            'party': party.id,
+            'price_list': (subscription.price_list.id
+                if subscription.price_list else None),
+            'sale_date': date_,
+            'state': 'draft',
+            'invoice_address': Party.address_get(party, type='invoice'),
+            'shipment_address': Party.address_get(party, type='delivery'),
+            'description': subscription.description,
+            }
+
+    @classmethod
+    def _create_sales(cls, subscriptions):
+        '''
+        Create, process and invoice the sales of the subscriptions in batch
+        '''
         pool = Pool()
-        Party = pool.get('party.party')
-        Sale = pool.get('sale.sale')
-        SaleLine = pool.get('sale.line')
-        Invoice = Pool().get('account.invoice')
         Configuration = pool.get('training.configuration')
-        configuration = Configuration(1)
-        SaleInvoice = Pool().get('sale.sale-account.invoice')
-        
+        Product = pool.get('product.product')
+        cursor = Transaction().cursor
+
+        default_charges = Product.browse(Configuration.get_default_charges())
+
         date_ = datetime.today().date()
-        
-        Model = pool.get('ir.model')
-        model = Model.search([('name', '=', str(cls.__name__))])
 
-        if not subscription.payment_term:
-            cls.raise_user_error('payterm_missing')
+        # List of (subscription, sale values, lines arguments, is source)
+        to_create = []
+        for subscription in subscriptions:
+            if not subscription.payment_term:
+                cls.raise_user_error('payterm_missing')
+            parties = cls._get_sale_parties(subscription)
 
-        if not subscription.price_list:
-            price_list = None
-        else:
-            price_list = subscription.price_list.id
-            
-        if not model:
-            model = 'subscription'
-        else:
-            model = model[0].name
-            
-        description = subscription.description
+            # Default charges are invoiced on their own sale
+            for product in default_charges:
+                for party, _ in parties:
+                    to_create.append((subscription,
+                            cls._get_sale_vals(subscription, party,
+                                subscription.code + ' ' + product.code,
+                                date_),
+                            [(1, product.template,
+                                    product.template.list_price)],
+                            False))
 
-        if subscription.invoice_method == 'by_subscriptor':
-            subscriptions_ = [(subscription.subscriptor, subscription.lines),]
-        
-        elif subscription.invoice_method == 'by_student':
-            subscriptions_ = [(subscription.student.name, subscription.lines), ]
-        else:
-            subscriptions_ = []
-            
-        #TODO again
-        #Add-Create default charges lines if exists
-        if configuration.default_charges:
-        
-            for product in configuration.default_charges:
-            
-                for party, lines in subscriptions_:
-                    sale, = Sale.create([{
-                        'company': subscription.company.id,
-                        'payment_term': subscription.payment_term.id,
-                        'subscription_code': subscription.code + ' ' + product.code,
-                        'party': party.id,
-                        'price_list' : price_list,
-                        'sale_date': date_,
-                        'state': 'draft',
-                        'invoice_address': Party.address_get(party, type='invoice'),
-                        'shipment_address': Party.address_get(party, type='delivery'),
-                        'description': description,
-                    }])
-                
-                    new_line = cls._create_new_line(
-                            sale, 1, product.template, 
-                            product.template.list_price
-                            )
+            # Party Subscription
+            for party, lines in parties:
+                to_create.append((subscription,
+                        cls._get_sale_vals(subscription, party,
+                            subscription.code, date_),
+                        [(l.quantity, l.session.offer.name, l.unit_price)
+                            for l in lines if l.quantity > 0],
+                        True))
+
+        for i in range(0, len(to_create), cursor.IN_MAX):
+            cls._process_sales(to_create[i:i + cursor.IN_MAX])
+
+    @classmethod
+    def _process_sales(cls, to_create):
+        '''
+        Create the sales of to_create with one create per model, run the
+        sale workflow and post the invoices on the whole list.
+        '''
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        SaleLine = pool.get('sale.line')
+        SaleInvoice = pool.get('sale.sale-account.invoice')
+        Invoice = pool.get('account.invoice')
+        SubscriptionSale = pool.get('training.subscription-sale.sale')
+        SubscriptionInvoice = pool.get('training.subscription-account.invoice')
+
+        History = pool.get('training.subscription.history')
+
+        if not to_create:
+            return
+        timer = PhaseTimer()
+        with timer.phase('sale_create'):
+            sales = Sale.create([vals for _, vals, _, _ in to_create])
+
+            new_lines = []
+            for sale, (_, _, lines, _) in zip(sales, to_create):
+                for quantity, template, unit_price in lines:
+                    new_line = cls._create_new_line(sale, quantity, template,
+                        unit_price)
                     if new_line:
-                        SaleLine.create([new_line])
+                        new_lines.append(new_line)
+            if new_lines:
+                SaleLine.create(new_lines)
 
-                Sale.quote([sale])
-                Sale.confirm([sale])
-                Sale.process([sale])
-                cls.write([subscription], {'sales': [('add', [sale.id])],
-                               'model_source':('sale.sale', sale.id), 
-                })
-        
-                saleinvoice = SaleInvoice.search([
-                    ('sale', '=', sale.id),
-                ])
-        
-                invoices = Invoice.search( [
-                    ('id', '=', saleinvoice[0].invoice.id)
-                ])
+        with timer.phase('sale_quote'):
+            Sale.quote(sales)
+        with timer.phase('sale_confirm'):
+            Sale.confirm(sales)
+        with timer.phase('sale_process'):
+            Sale.process(sales)
 
-                Invoice.write(invoices, {
-                    'reference': sale.subscription_code,
-                    'invoice_date': sale.sale_date,
-                })
+        sale2invoices = {}
+        with timer.phase('invoice_search'):
+            for saleinvoice in SaleInvoice.search([
+                        ('sale', 'in', [s.id for s in sales]),
+                        ]):
+                sale2invoices.setdefault(saleinvoice.sale.id, []).append(
+                    saleinvoice.invoice)
 
-                Invoice.post(invoices)
-                   
-                if invoices:
-                    for invoice in invoices:
-                        cls.write([subscription], {'invoices': [('add', [invoice.id])],   
+        # Group the invoices sharing the same values to write them at once
+        to_write = {}
+        subscription_sales = []
+        subscription_invoices = []
+        sources = {}
+        for sale, (subscription, _, _, source) in zip(sales, to_create):
+            subscription_sales.append({
+                    'subscription': subscription.id,
+                    'sale': sale.id,
                     })
+            if source:
+                sources[subscription] = sale
+            invoices = sale2invoices.get(sale.id, [])
+            to_write.setdefault((sale.subscription_code, sale.sale_date),
+                []).extend(invoices)
+            for invoice in invoices:
+                subscription_invoices.append({
+                        'subscription': subscription.id,
+                        'invoice': invoice.id,
+                        })
 
-        # Party Subscription 
-        for party, lines in subscriptions_:
-            sale, = Sale.create([{
-                'company': subscription.company.id,
-                'payment_term': subscription.payment_term.id,
-                'subscription_code': subscription.code,
-                'party': party.id,
-                'price_list' : price_list,
-                'sale_date': date_,
-                'state': 'draft',
-                'invoice_address': Party.address_get(party, type='invoice'),
-                'shipment_address': Party.address_get(party, type='delivery'),
-                'description': description,
-                }])
-
-            for res_line in lines:
-                if res_line.quantity <= 0:
+        invoices = []
+        with timer.phase('invoice_post'):
+            for (reference, invoice_date), key_invoices in \
+                    to_write.iteritems():
+                if not key_invoices:
                     continue
-                new_line = cls._create_new_line(
-                        sale, res_line.quantity, res_line.session.offer.name,
-                        res_line.unit_price
-                        )
-                if new_line:
-                    SaleLine.create([new_line])
-
-        Sale.quote([sale])
-        Sale.confirm([sale])
-        Sale.process([sale])
-        cls.write([subscription], {'sales': [('add', [sale.id])],
-                                   'model_source':('sale.sale', sale.id), 
-                                   })
-        
-        saleinvoice = SaleInvoice.search([
-                ('sale', '=', sale.id),
-                ])
-        
-        invoices = Invoice.search( [
-                ('id', '=', saleinvoice[0].invoice.id)
-                ])
+                Invoice.write(key_invoices, {
+                        'reference': reference,
+                        'invoice_date': invoice_date,
+                        })
+                invoices.extend(key_invoices)
+            if invoices:
+                Invoice.post(invoices)
 
-        Invoice.write(invoices, {
-                'reference': sale.subscription_code,
-                'invoice_date': sale.sale_date,
-                })
+        SubscriptionSale.create(subscription_sales)
+        if subscription_invoices:
+            SubscriptionInvoice.create(subscription_invoices)
+        for subscription, sale in sources.iteritems():
+            cls.write([subscription], {
+                    'model_source': ('sale.sale', sale.id),
+                    })
+
+        # One history per subscription, the phases of the batch are
+        # stored on the first one only
+        sale_counts = {}
+        for subscription, _, _, _ in to_create:
+            sale_counts.setdefault(subscription.id, 0)
+            sale_counts[subscription.id] += 1
+        History.create([{
+                    'subscription': subscription_id,
+                    'log': cls.raise_user_error(error='sales_created',
+                        error_args=(count,), raise_exception=False),
+                    'phases': ([('create', timer.get_values())]
+                        if i == 0 else []),
+                    } for i, (subscription_id, count) in enumerate(
+                    sorted(sale_counts.iteritems()))])
 
-        Invoice.post(invoices)
-        if invoices:
-            for invoice in invoices:
-                cls.write([subscription], {'invoices': [('add', [invoice.id])],   
-                                   })
-        
     @classmethod
     def _create_new_line(cls, sale, quantity, template, unit_price):
         pool = Pool()
@@ -510,6 +851,65 @@ class TrainingSubscription(Workflow, ModelView, ModelSQL):
     @ModelView.button
     @Workflow.transition('processing')
     def processing(cls, subscriptions):
+        Configuration = Pool().get('training.configuration')
+        cls.check_sales_created(subscriptions)
+        cls._update_seats([s for s in subscriptions if s.state == 'stop'], 1)
+        if Configuration(1).scheduler == 'dispatcher':
+            cls._schedule(subscriptions)
+        else:
+            cls._create_crons(subscriptions)
+        cls._materialize_occurrences(cls.browse([s.id for s in subscriptions]))
+
+    @classmethod
+    def check_sales_created(cls, subscriptions):
+        '''
+        Check the deferred confirmation of the subscriptions has created
+        their sales
+        '''
+        Queue = Pool().get('training.subscription.queue')
+        jobs = Queue.search([
+                ('subscription', 'in', [s.id for s in subscriptions]),
+                ('state', '!=', 'done'),
+                ], limit=1)
+        if jobs:
+            cls.raise_user_error('sales_pending',
+                jobs[0].subscription.rec_name)
+
+    @classmethod
+    def _schedule(cls, subscriptions):
+        '''
+        Schedule the subscriptions on the dispatcher
+        '''
+        Cron = Pool().get('ir.cron')
+        crons = [s.cron for s in subscriptions if s.cron]
+        for subscription in subscriptions:
+            vals = {
+                'cron': None,
+                'state': 'processing',
+                }
+            # A stopped subscription resumes its schedule, from its own
+            # scheduler if it was stopped while using one
+            if subscription.state == 'stop' and subscription.remaining_calls:
+                pass
+            elif subscription.state == 'stop' and subscription.cron:
+                vals['next_due'] = subscription.cron.next_call
+                vals['remaining_calls'] = subscription.cron.number_calls
+            else:
+                vals['next_due'] = subscription.next_call
+                vals['remaining_calls'] = subscription.number_calls or 1
+            cls.write([subscription], vals)
+        # The schedulers are replaced by the dispatcher
+        if crons:
+            Cron.delete(crons)
+
+    @classmethod
+    def _create_crons(cls, subscriptions):
+        '''
+        Create a scheduler for each subscription
+        '''
+        Cron = Pool().get('ir.cron')
+
+        to_create = []
         for subscription in subscriptions:
             vals = {
                 'model': subscription.__name__,
@@ -523,118 +923,694 @@ class TrainingSubscription(Workflow, ModelView, ModelSQL):
                 'args': str([subscription.id]),
                 'function': 'model_copy',
             }
-            Cron = Pool().get('ir.cron')
-            domain = [
-                ('model', '=', subscription.__name__),
-                ('name', '=', subscription.code),
-                ('active', '=', False),
-            ]
-            cron = Cron.search([domain])
-            if not cron:
-                cron = Cron.create([vals])[0]
-            else:
+            # A stopped subscription reactivates its own scheduler
+            if subscription.cron:
                 vals['active'] = True
-                Cron.write(cron, vals)
-                cron = cron[0]
-            vals = {
-                'cron': cron.id,
-                'state': 'processing',
-            }
-            cls.write([subscription], vals)
+                Cron.write([subscription.cron], vals)
+                cls.write([subscription], {'state': 'processing'})
+            else:
+                to_create.append((subscription, vals))
+        if to_create:
+            crons = Cron.create([v for _, v in to_create])
+            for (subscription, _), cron in zip(to_create, crons):
+                cls.write([subscription], {
+                        'cron': cron.id,
+                        'state': 'processing',
+                        })
+
+    @staticmethod
+    def _get_interval(subscription, count=1):
+        return relativedelta(**{
+                subscription.interval_type: (
+                    subscription.interval_number * count),
+                })
 
     @classmethod
-    def model_copy(cls, subscription_id):
+    def _materialize_occurrences(cls, subscriptions):
+        '''
+        Replace the pending occurrences of the subscriptions by one
+        occurrence per remaining call
+        '''
+        Occurrence = Pool().get('training.subscription.occurrence')
+
+        Occurrence.delete(Occurrence.search([
+                    ('subscription', 'in', [s.id for s in subscriptions]),
+                    ('state', '=', 'pending'),
+                    ]))
+        to_create = []
+        for subscription in subscriptions:
+            start = subscription.next_due or subscription.next_call
+            if not start:
+                continue
+            remaining = cls._get_remaining_calls(subscription) or 1
+            billed = max((subscription.number_calls or 1) - remaining, 0)
+            for i in range(remaining):
+                to_create.append((subscription, {
+                            'subscription': subscription.id,
+                            'number': billed + i + 1,
+                            'due_date': start + cls._get_interval(
+                                subscription, i),
+                            }))
+        if to_create:
+            cls._stagger(to_create)
+            Occurrence.create([v for _, v in to_create])
+
+    @classmethod
+    def _stagger(cls, to_create):
+        '''
+        Set the execution time of the occurrences values.
+        The due date, used as billing date, is kept and only the execution
+        is spread over the window and the hourly quota of the configuration.
+        '''
+        pool = Pool()
+        Configuration = pool.get('training.configuration')
+        Occurrence = pool.get('training.subscription.occurrence')
+        occurrence = Occurrence.__table__()
+        subscription = cls.__table__()
+        cursor = Transaction().cursor
+
+        configuration = Configuration(1)
+        window = (configuration.stagger_window or 0) * 60
+        quota = configuration.stagger_quota or 0
+
+        taken = {}
+
+        def slots(company_id, hour):
+            key = (company_id, hour)
+            if key not in taken:
+                cursor.execute(*occurrence.join(subscription,
+                        condition=occurrence.subscription == subscription.id
+                        ).select(Count(occurrence.id),
+                        where=(occurrence.state == 'pending')
+                        & (subscription.company == company_id)
+                        & (occurrence.run_at >= hour)
+                        & (occurrence.run_at < hour + timedelta(hours=1))))
+                taken[key], = cursor.fetchone()
+            return taken[key]
+
+        for sub, vals in sorted(to_create,
+                key=lambda v: (v[1]['due_date'], v[1]['subscription'])):
+            run_at = vals['due_date']
+            if window:
+                # Deterministic offset so a subscription keeps its slot
+                run_at += timedelta(
+                    seconds=(sub.id * 2654435761) % window)
+            if quota:
+                company_id = sub.company.id
+                hour = run_at.replace(minute=0, second=0, microsecond=0)
+                while slots(company_id, hour) >= quota:
+                    hour += timedelta(hours=1)
+                position = slots(company_id, hour)
+                taken[(company_id, hour)] += 1
+                run_at = max(run_at,
+                    hour + timedelta(seconds=3600 * position // quota))
+            vals['run_at'] = run_at
+
+    @classmethod
+    def _get_remaining_calls(cls, subscription):
         Cron = Pool().get('ir.cron')
-        History = Pool().get('training.subscription.history')
-        Invoice = Pool().get('account.invoice')
-        Sale = Pool().get('sale.sale')
-        SaleInvoice = Pool().get('sale.sale-account.invoice')
+        if subscription.cron:
+            return Cron.browse([subscription.cron.id])[0].number_calls
+        return subscription.remaining_calls
+
+    @classmethod
+    def dispatch(cls):
+        '''
+        Bill the due occurrences of the dispatcher.
+        Each subscription is billed at most once per run.
+        '''
+        Configuration = Pool().get('training.configuration')
+        cursor = Transaction().cursor
+
+        cls._materialize_missing_occurrences()
+        subscription_ids = cls._get_due_subscriptions()
+
+        workers = Configuration(1).billing_workers or 1
+        if (workers > 1 and cls._skip_locked()
+                and len(subscription_ids) > cursor.IN_MAX):
+            # The workers must see the occurrences materialized above
+            cursor.commit()
+            cls._dispatch_parallel(subscription_ids, workers)
+        else:
+            for i in range(0, len(subscription_ids), cursor.IN_MAX):
+                cls._dispatch_claimed(
+                    subscription_ids[i:i + cursor.IN_MAX])
+
+    @classmethod
+    def _get_due_subscriptions(cls):
+        '''
+        Return the ids of the dispatched subscriptions with a due occurrence
+        '''
+        Occurrence = Pool().get('training.subscription.occurrence')
+        subscription = cls.__table__()
+        occurrence = Occurrence.__table__()
+        cursor = Transaction().cursor
+
+        cursor.execute(*occurrence.join(subscription,
+                condition=occurrence.subscription == subscription.id
+                ).select(occurrence.subscription,
+                where=(occurrence.state == 'pending')
+                & (occurrence.run_at <= datetime.now())
+                & (subscription.state == 'processing')
+                & (subscription.cron == Null),
+                group_by=occurrence.subscription,
+                order_by=occurrence.subscription))
+        return [i for i, in cursor.fetchall()]
+
+    @staticmethod
+    def _skip_locked():
+        '''
+        Return True if the database can skip the rows locked by another
+        worker
+        '''
+        if backend.name() != 'postgresql':
+            return False
+        cursor = Transaction().cursor
+        cursor.execute('SHOW server_version_num')
+        version, = cursor.fetchone()
+        # SKIP LOCKED is available since PostgreSQL 9.5
+        return int(version) >= 90500
+
+    @classmethod
+    def _dispatch_parallel(cls, subscription_ids, workers):
+        '''
+        Spread the billing of the subscriptions over workers processes.
+        Each worker runs in a new interpreter as the server process can
+        not be forked safely.
+        '''
+        from trytond.config import CONFIG
+        transaction = Transaction()
+        logger = logging.getLogger('training_subscription')
+        command = [sys.executable, '-m',
+            __name__.rsplit('.', 1)[0] + '.dispatch']
+        if CONFIG.configfile:
+            command.append(CONFIG.configfile)
+
+        processes = []
+        for i in range(workers):
+            process = subprocess.Popen(command, stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE)
+            # Send the payload to each worker before waiting for any of
+            # them so they all run at the same time
+            process.stdin.write(json.dumps({
+                        'database': transaction.cursor.database_name,
+                        'user': transaction.user,
+                        'context': transaction.context,
+                        'subscriptions': subscription_ids[i::workers],
+                        'chunk': transaction.cursor.IN_MAX,
+                        }))
+            process.stdin.close()
+            processes.append(process)
+        billed = 0
+        for process in processes:
+            output = process.stdout.read()
+            process.wait()
+            if process.returncode:
+                logger.error('Billing worker exited with code %s'
+                    % process.returncode)
+                continue
+            billed += int(output.strip() or 0)
+        logger.info('%s subscriptions billed by %s workers'
+            % (billed, workers))
+
+    @classmethod
+    def _dispatch_claimed(cls, subscription_ids):
+        '''
+        Claim the subscriptions still due and bill them.
+        On PostgreSQL the rows locked by another worker are skipped so a
+        subscription is never billed twice. Before PostgreSQL 9.5, the
+        chunk is left to the worker holding one of its rows.
+        Return the number of subscriptions billed.
+        '''
+        Occurrence = Pool().get('training.subscription.occurrence')
+        table = cls.__table__()
+        occurrence = Occurrence.__table__()
+        cursor = Transaction().cursor
+        logger = logging.getLogger('training_subscription')
+
+        query = table.select(table.id,
+            where=table.id.in_(subscription_ids)
+            & (table.state == 'processing')
+            & (table.cron == Null)
+            & table.id.in_(occurrence.select(occurrence.subscription,
+                    where=(occurrence.state == 'pending')
+                    & (occurrence.run_at <= datetime.now()))))
+        if cls._skip_locked():
+            query, params = tuple(query)
+            cursor.execute(query + ' FOR UPDATE SKIP LOCKED', params)
+        elif backend.name() == 'postgresql':
+            query, params = tuple(query)
+            cursor.execute('SAVEPOINT training_subscription_claim')
+            try:
+                cursor.execute(query + ' FOR UPDATE NOWAIT', params)
+            except Exception:
+                cursor.execute(
+                    'ROLLBACK TO SAVEPOINT training_subscription_claim')
+                logger.info('Subscriptions %s are billed by another worker'
+                    % subscription_ids)
+                return 0
+            cursor.execute('RELEASE SAVEPOINT training_subscription_claim')
+        else:
+            cursor.execute(*query)
+        claimed = [i for i, in cursor.fetchall()]
+        billed = 0
+        for subscription_id in claimed:
+            if cls._bill_isolated(subscription_id):
+                billed += 1
+        cls._advance(cls.browse(claimed))
+        return billed
+
+    @classmethod
+    def _bill_isolated(cls, subscription_id):
+        '''
+        Bill the subscription inside a savepoint so a failure only rolls
+        back its own changes and is logged in its history.
+        The due occurrences of a failed subscription are postponed.
+        Return True if the subscription was billed.
+        '''
+        pool = Pool()
+        History = pool.get('training.subscription.history')
+        Occurrence = pool.get('training.subscription.occurrence')
+        cursor = Transaction().cursor
+        logger = logging.getLogger('training_subscription')
+
+        if backend.name() != 'postgresql':
+            # The sqlite3 module commits the transaction before a
+            # SAVEPOINT, so a failure stops the whole run
+            cls.model_copy(subscription_id)
+            return True
+
+        cursor.execute('SAVEPOINT training_subscription_bill')
+        try:
+            cls.model_copy(subscription_id)
+        except Exception:
+            error = traceback.format_exc()
+            cursor.execute('ROLLBACK TO SAVEPOINT training_subscription_bill')
+            # The records cached before the rollback are no longer valid
+            cursor.cache.clear()
+            logger.error('Error billing subscription %s' % subscription_id,
+                exc_info=True)
+            Occurrence.postpone(Occurrence.search([
+                        ('subscription', '=', subscription_id),
+                        ('state', '=', 'pending'),
+                        ('run_at', '<=', datetime.now()),
+                        ]))
+            History.create([{
+                        'subscription': subscription_id,
+                        'success': False,
+                        'log': cls.raise_user_error(
+                            error='billing_failed',
+                            error_args=error.strip().splitlines()[-1],
+                            raise_exception=False),
+                        }])
+            return False
+        cursor.execute('RELEASE SAVEPOINT training_subscription_bill')
+        return True
+
+    @classmethod
+    def _materialize_missing_occurrences(cls):
+        '''
+        Materialize the occurrences of the scheduled subscriptions which
+        have none, like those migrated from a scheduler per subscription
+        '''
+        Occurrence = Pool().get('training.subscription.occurrence')
+        subscription = cls.__table__()
+        occurrence = Occurrence.__table__()
+        cursor = Transaction().cursor
+
+        cursor.execute(*subscription.select(subscription.id,
+                where=(subscription.state == 'processing')
+                & (subscription.cron == Null)
+                & (subscription.remaining_calls > 0)
+                & ~subscription.id.in_(occurrence.select(
+                        occurrence.subscription,
+                        where=occurrence.state == 'pending'))))
+        subscription_ids = [i for i, in cursor.fetchall()]
+        for i in range(0, len(subscription_ids), cursor.IN_MAX):
+            cls._materialize_occurrences(
+                cls.browse(subscription_ids[i:i + cursor.IN_MAX]))
+
+    @classmethod
+    def _advance(cls, subscriptions):
+        '''
+        Move the schedule of the dispatched subscriptions to their next
+        pending occurrence
+        '''
+        pool = Pool()
+        Occurrence = pool.get('training.subscription.occurrence')
+        occurrence = Occurrence.__table__()
+        cursor = Transaction().cursor
+
+        pending = {}
+        for i in range(0, len(subscriptions), cursor.IN_MAX):
+            sub_ids = [s.id for s in subscriptions[i:i + cursor.IN_MAX]]
+            cursor.execute(*occurrence.select(occurrence.subscription,
+                    occurrence.due_date,
+                    where=(occurrence.state == 'pending')
+                    & occurrence.subscription.in_(sub_ids),
+                    order_by=occurrence.due_date.desc))
+            for subscription_id, due_date in cursor.fetchall():
+                count = pending.get(subscription_id, (None, 0))[1]
+                pending[subscription_id] = (due_date, count + 1)
+
+        finished = []
+        for subscription in subscriptions:
+            if (subscription.id not in pending
+                    or subscription.state != 'processing'):
+                finished.append(subscription)
+                continue
+            due_date, count = pending[subscription.id]
+            cls.write([subscription], {
+                    'next_due': due_date,
+                    'remaining_calls': count,
+                    })
+        if finished:
+            cls.write(finished, {
+                    'next_due': None,
+                    'remaining_calls': 0,
+                    })
+
+    @classmethod
+    def model_copy(cls, subscription_id):
+        Occurrence = Pool().get('training.subscription.occurrence')
         
         subscription = cls(subscription_id)
         logger = logging.getLogger('training_subscription')
-        number_calls = subscription.number_calls
-        remaining = Cron.browse([subscription.cron.id])[0].number_calls
-        actual = number_calls - remaining + 1
+        remaining = cls._get_remaining_calls(subscription)
         model_id = subscription.model_source and subscription.model_source.id \
                 or False
         if model_id:
-            Model = Pool().get(subscription.model_source.__name__)
-            default = {'state':'draft'}
-            #default['subscription_code'] = subscription.model_source.subscription_code + ' ' +str(actual)
-            default['subscription_code'] = subscription.model_source.subscription_code
-
-            try:
-                model = Model.copy([subscription.model_source], default)
-            except:
-                history_vals = {
-                    'log': cls.raise_user_error(
-                        error='error_creating',
-                        error_args=subscription.model_source.__name__, 
-                        raise_exception=False)
-                }
-            else:
-                history_vals = {
-                    'log': cls.raise_user_error(
-                        error='created_successfully',
-                        error_args=subscription.model_source.__name__, 
-                        raise_exception=False)
-                }
-                history_vals['document'] = (subscription.model_source.__name__,
-                                        model[0].id)
-            History.create([history_vals])
-            
-            sales = Sale.search([
-                         ('id','=',model[0].id)
-                         ])
-            
-            for sale in sales:
-                Sale.quote([sale])
-                Sale.confirm([sale])
-                Sale.process([sale])
-                
-                saleinvoices = SaleInvoice.search([
-                    ('sale', '=', sale.id),
+            scheduled = Occurrence.search_count([
+                    ('subscription', '=', subscription.id),
                     ])
-                invoices = Invoice.search( [
-                    ('id','=',saleinvoices[0].invoice.id)
-                    ])
-                Invoice.write(invoices, {
-                    'reference': sale.subscription_code,
-                    'invoice_date': sale.sale_date,
-                    })
-                Invoice.post(invoices)
-                
-                if invoices:
-                    for invoice in invoices:
-                        cls.write([subscription], 
-                                           {'sales': [('add', [sale.id])],
-                                           'invoices': [('add', [invoice.id])]
-                                               })
-
-            # If it is the last cron execution, set the state of the
+            occurrences = cls._get_occurrences_to_bill(subscription)
+            if scheduled and not occurrences:
+                # Everything due was already billed, by a catch-up for
+                # example
+                return
+            if not cls._copy_source(subscription, occurrences or [None]):
+                return
+
+            # If it is the last execution, set the state of the
             # subscription to done
-            if remaining == 1:
+            if scheduled:
+                finished = not Occurrence.search_count([
+                        ('subscription', '=', subscription.id),
+                        ('state', '=', 'pending'),
+                        ])
+            else:
+                finished = remaining == 1
+            if finished:
+                cls._update_seats([subscription], -1)
                 subscription.write([subscription], {'state': 'done'})
         else:
             logger.error('Document in subscription %s not found.\n' % \
                          subscription.code)   
-    
+
     @classmethod
-    @ModelView.button
-    @Workflow.transition('done')
-    def done(cls, subscriptions):
-        for subscription in subscriptions:
-            Pool().get('ir.cron').write([subscription.cron], {'active': False})
-            cls.write([subscription], {'state':'done'})
-    
-    def get_total_amount(self, name):
-        res = Decimal(0)
-        if self.lines:
-            for line in self.lines:
-                res += line.total_amount
-        return res
+    def _get_occurrences_to_bill(cls, subscription):
+        '''
+        Return the pending occurrences to bill for the subscription.
+        In catch-up mode, all the missed occurrences are billed at once but
+        never those still to come.
+        '''
+        pool = Pool()
+        Configuration = pool.get('training.configuration')
+        Occurrence = pool.get('training.subscription.occurrence')
 
-    def on_change_lines(self):
+        configuration = Configuration(1)
+        pending = Occurrence.search([
+                ('subscription', '=', subscription.id),
+                ('state', '=', 'pending'),
+                ], order=[('due_date', 'ASC')])
+        if (configuration.catch_up
+                and configuration.scheduler == 'dispatcher'):
+            now = datetime.now()
+            return [o for o in pending if o.run_at <= now]
+        return pending[:1]
+
+    @classmethod
+    def _copy_source(cls, subscription, occurrences):
+        '''
+        Copy the source document once per occurrence, dated on the
+        occurrence, and process the copies together.
+        Return False if the source document could not be copied.
+        '''
+        pool = Pool()
+        History = pool.get('training.subscription.history')
+        Occurrence = pool.get('training.subscription.occurrence')
+        Invoice = pool.get('account.invoice')
+        Sale = pool.get('sale.sale')
+        SubscriptionSale = pool.get('training.subscription-sale.sale')
+        SubscriptionInvoice = pool.get('training.subscription-account.invoice')
+
+        source = subscription.model_source
+        Model = pool.get(source.__name__)
+        timer = PhaseTimer()
+
+        copies = []
+        try:
+            with timer.phase('copy'):
+                if source.__name__ == 'sale.sale':
+                    copies = cls._create_from_template(subscription,
+                        occurrences)
+                else:
+                    for occurrence in occurrences:
+                        default = {'state': 'draft'}
+                        default['subscription_code'] = \
+                            source.subscription_code
+                        if occurrence:
+                            default['sale_date'] = occurrence.due_date.date()
+                        copies.extend(Model.copy([source], default))
+        except:
+            History.create([{
+                'subscription': subscription.id,
+                'success': False,
+                'log': cls.raise_user_error(
+                    error='error_creating',
+                    error_args=source.__name__, 
+                    raise_exception=False),
+                'phases': [('create', timer.get_values())],
+            }])
+            return False
+
+        if source.__name__ == 'sale.sale':
+            sales = copies
+        else:
+            with timer.phase('sale_search'):
+                sales = Sale.search([
+                        ('id', 'in', [c.id for c in copies]),
+                        ])
+        if sales:
+            with timer.phase('sale_quote'):
+                Sale.quote(sales)
+            with timer.phase('sale_confirm'):
+                Sale.confirm(sales)
+            with timer.phase('sale_process'):
+                Sale.process(sales)
+
+        with timer.phase('invoice_post'):
+            # Read the sales again to get the invoices created by process
+            sales = Sale.browse([s.id for s in sales])
+            invoices = []
+            for sale in sales:
+                sale_invoices = list(sale.invoices)
+                if not sale_invoices:
+                    continue
+                Invoice.write(sale_invoices, {
+                    'reference': sale.subscription_code,
+                    'invoice_date': sale.sale_date,
+                    })
+                invoices.extend(sale_invoices)
+            if invoices:
+                Invoice.post(invoices)
+
+        SubscriptionSale.create([{
+                    'subscription': subscription.id,
+                    'sale': s.id,
+                    } for s in sales])
+        if invoices:
+            SubscriptionInvoice.create([{
+                        'subscription': subscription.id,
+                        'invoice': i.id,
+                        } for i in invoices])
+
+        log = cls.raise_user_error(error='created_successfully',
+            error_args=source.__name__, raise_exception=False)
+        History.create([{
+                    'subscription': subscription.id,
+                    'log': log,
+                    'document': (source.__name__, document.id),
+                    'phases': [('create', timer.get_values())] if i == 0 else [],
+                    } for i, document in enumerate(copies)])
+        for occurrence, document in zip(occurrences, copies):
+            if occurrence:
+                Occurrence.write([occurrence], {
+                        'state': 'done',
+                        'document': (source.__name__, document.id),
+                        })
+        return True
+
+    @classmethod
+    def _get_billing_template(cls, subscription):
+        '''
+        Return the header and lines values of the source sale to create
+        the recurring sales from.
+        As with Sale.copy, the reference is not kept.
+        The template is cached until the source sale or its lines are
+        modified.
+        '''
+        SaleLine = Pool().get('sale.line')
+        sale_line = SaleLine.__table__()
+        cursor = Transaction().cursor
+
+        source = subscription.model_source
+        # The count detects the deleted lines
+        cursor.execute(*sale_line.select(
+                Max(Coalesce(sale_line.write_date, sale_line.create_date)),
+                Count(sale_line.id),
+                where=sale_line.sale == source.id))
+        lines_date, lines_count = cursor.fetchone()
+        key = (subscription.id, source.id,
+            str(source.write_date or source.create_date),
+            str(lines_date), lines_count)
+        template = cls._billing_template_cache.get(key)
+        if template is not None:
+            return template
+
+        def id_(record):
+            return record.id if record else None
+
+        header = {
+            'company': id_(source.company),
+            'party': id_(source.party),
+            'currency': id_(source.currency),
+            'payment_term': id_(source.payment_term),
+            'price_list': id_(source.price_list),
+            'invoice_address': id_(source.invoice_address),
+            'shipment_address': id_(source.shipment_address),
+            'warehouse': id_(source.warehouse),
+            'invoice_method': source.invoice_method,
+            'shipment_method': source.shipment_method,
+            'description': source.description,
+            'comment': source.comment,
+            'subscription_code': source.subscription_code,
+            }
+        lines = []
+        for line in source.lines:
+            lines.append({
+                    'type': line.type,
+                    'sequence': line.sequence,
+                    'product': id_(line.product),
+                    'unit': id_(line.unit),
+                    'quantity': line.quantity,
+                    'unit_price': line.unit_price,
+                    'description': line.description,
+                    'note': line.note,
+                    'taxes': tuple(t.id for t in line.taxes),
+                    })
+        template = (header, tuple(lines))
+        cls._billing_template_cache.set(key, template)
+        return template
+
+    @classmethod
+    def _create_from_template(cls, subscription, occurrences):
+        '''
+        Create in draft the sales of the occurrences from the billing
+        template of the subscription.
+        The values are those of the template, not of Sale.copy, so the
+        copy defaults added by other modules to sale.sale and sale.line
+        are not applied. Those modules must extend the template.
+        '''
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        SaleLine = pool.get('sale.line')
+
+        header, lines = cls._get_billing_template(subscription)
+        vlist = []
+        for occurrence in occurrences:
+            vals = header.copy()
+            vals['state'] = 'draft'
+            vals['sale_date'] = (occurrence.due_date.date()
+                if occurrence else None)
+            vlist.append(vals)
+        sales = Sale.create(vlist)
+
+        to_create = []
+        for sale in sales:
+            for line in lines:
+                vals = line.copy()
+                vals['sale'] = sale.id
+                vals['taxes'] = [('add', list(line['taxes']))]
+                to_create.append(vals)
+        if to_create:
+            SaleLine.create(to_create)
+        return sales
+    
+    @classmethod
+    @ModelView.button
+    @Workflow.transition('done')
+    def done(cls, subscriptions):
+        pool = Pool()
+        Cron = pool.get('ir.cron')
+        Occurrence = pool.get('training.subscription.occurrence')
+        crons = [s.cron for s in subscriptions if s.cron]
+        if crons:
+            Cron.write(crons, {'active': False})
+        cls._update_seats([s for s in subscriptions
+                if s.state in CONFIRMED_STATES], -1)
+        Occurrence.write(Occurrence.search([
+                    ('subscription', 'in', [s.id for s in subscriptions]),
+                    ('state', '=', 'pending'),
+                    ]), {'state': 'cancel'})
+        cls.write(subscriptions, {
+                'state': 'done',
+                'next_due': None,
+                })
+    
+    @classmethod
+    def get_total_amount(cls, subscriptions, name):
+        Line = Pool().get('training.subscription.line')
+        line = Line.__table__()
+        cursor = Transaction().cursor
+
+        ids = [s.id for s in subscriptions]
+        amounts = dict((i, _ZERO) for i in ids)
+        for i in range(0, len(ids), cursor.IN_MAX):
+            sub_ids = ids[i:i + cursor.IN_MAX]
+            cursor.execute(*line.select(line.subscription,
+                    Sum(Line._get_amount_column(line)),
+                    where=line.subscription.in_(sub_ids),
+                    group_by=line.subscription))
+            for subscription_id, amount in cursor.fetchall():
+                # SQLite uses float for SUM
+                if not isinstance(amount, Decimal):
+                    amount = Decimal(str(amount))
+                amounts[subscription_id] = amount
+        return amounts
+
+    @classmethod
+    def _get_total_amount_column(cls, table):
+        Line = Pool().get('training.subscription.line')
+        line = Line.__table__()
+        return Coalesce(line.select(Sum(Line._get_amount_column(line)),
+                where=line.subscription == table.id), _ZERO)
+
+    @classmethod
+    def search_total_amount(cls, name, clause):
+        table = cls.__table__()
+        _, operator, value = clause
+        return [('id', 'in', table.select(table.id,
+                    where=_get_sql_clause(cls._get_total_amount_column(table),
+                        operator, value)))]
+
+    @staticmethod
+    def order_total_amount(tables):
+        Subscription = Pool().get('training.subscription')
+        table, _ = tables[None]
+        return [Subscription._get_total_amount_column(table)]
+
+    def on_change_lines(self):
         res = {
                'total_amount':Decimal('0'),
                'number_calls':Decimal('0')
@@ -648,27 +1624,170 @@ class TrainingSubscription(Workflow, ModelView, ModelSQL):
                     res['number_calls'] += line.number_calls
         return res
     
-    def get_session(self, name=None):
-        res = {}
-        if self.lines:
-            return self.lines[0].session.name
-        return res
+    @staticmethod
+    def _get_first_line_query(line, where=None):
+        '''
+        Return the query of the first line of each subscription
+        '''
+        return line.select(Min(line.id), where=where,
+            group_by=line.subscription)
+
+    @classmethod
+    def get_session(cls, subscriptions, name):
+        '''
+        The session name of the first line of the subscriptions.
+        '''
+        pool = Pool()
+        Line = pool.get('training.subscription.line')
+        Session = pool.get('training.session')
+        line = Line.__table__()
+        session = Session.__table__()
+        cursor = Transaction().cursor
+
+        ids = [s.id for s in subscriptions]
+        sessions = dict((i, None) for i in ids)
+        for i in range(0, len(ids), cursor.IN_MAX):
+            sub_ids = ids[i:i + cursor.IN_MAX]
+            first = Line.__table__()
+            cursor.execute(*line.join(session,
+                    condition=line.session == session.id
+                    ).select(line.subscription, session.name,
+                    where=line.id.in_(cls._get_first_line_query(first,
+                            where=first.subscription.in_(sub_ids)))))
+            sessions.update(cursor.fetchall())
+        return sessions
+
+    @classmethod
+    def search_session(cls, name, clause):
+        pool = Pool()
+        Line = pool.get('training.subscription.line')
+        Session = pool.get('training.session')
+        line = Line.__table__()
+        first = Line.__table__()
+        session = Session.__table__()
+
+        _, operator, value = clause
+        query = line.join(session,
+            condition=line.session == session.id
+            ).select(line.subscription,
+            where=line.id.in_(cls._get_first_line_query(first))
+            & _get_sql_clause(session.name, operator, value))
+        return [('id', 'in', query)]
+
+    @classmethod
+    def get_dashboard(cls, cache=True):
+        '''
+        Return the aggregates of the operations dashboard for the company
+        of the context.
+        The values are cached for DASHBOARD_TIMEOUT seconds unless cache
+        is False.
+        '''
+        pool = Pool()
+        ModelAccess = pool.get('ir.model.access')
+        User = pool.get('res.user')
+        transaction = Transaction()
+
+        # The aggregates are computed in SQL, so check the access here
+        ModelAccess.check(cls.__name__, 'read')
+        company = transaction.context.get('company')
+        if transaction.user != 0:
+            user = User(transaction.user)
+            if not company or not user.company or user.company.id != company:
+                cls.raise_user_error('dashboard_company')
+        if cache:
+            cached = cls._dashboard_cache.get(company)
+            if cached is not None:
+                timestamp, values = cached
+                if time.time() - timestamp < DASHBOARD_TIMEOUT:
+                    return values
+        values = cls._get_dashboard(company)
+        cls._dashboard_cache.set(company, (time.time(), values))
+        return values
+
+    @classmethod
+    def _get_dashboard(cls, company):
+        pool = Pool()
+        Line = pool.get('training.subscription.line')
+        Occurrence = pool.get('training.subscription.occurrence')
+        History = pool.get('training.subscription.history')
+        Queue = pool.get('training.subscription.queue')
+        subscription = cls.__table__()
+        line = Line.__table__()
+        occurrence = Occurrence.__table__()
+        history = History.__table__()
+        queue = Queue.__table__()
+        cursor = Transaction().cursor
+
+        today = datetime.combine(datetime.today().date(), datetime.min.time())
+        week_start = today - timedelta(days=today.weekday())
+        week_end = week_start + timedelta(days=7)
+        of_company = subscription.company == company
+
+        cursor.execute(*subscription.select(subscription.state,
+                Count(subscription.id),
+                where=of_company & (subscription.active == True),
+                group_by=subscription.state))
+        states = dict(cursor.fetchall())
+
+        due = (of_company
+            & (subscription.state == 'processing')
+            & (occurrence.state == 'pending')
+            & (occurrence.due_date >= week_start)
+            & (occurrence.due_date < week_end))
+        cursor.execute(*occurrence.join(subscription,
+                condition=occurrence.subscription == subscription.id
+                ).select(Count(occurrence.id), where=due))
+        due_occurrences, = cursor.fetchone()
+        cursor.execute(*occurrence.join(subscription,
+                condition=occurrence.subscription == subscription.id
+                ).join(line, condition=line.subscription == subscription.id
+                ).select(Sum(Line._get_amount_column(line)), where=due))
+        due_amount, = cursor.fetchone()
+        if not isinstance(due_amount, Decimal):
+            due_amount = Decimal(str(due_amount or 0))
+
+        cursor.execute(*history.join(subscription,
+                condition=history.subscription == subscription.id
+                ).select(Count(history.id),
+                where=of_company & (history.success == False)
+                & (history.date >= week_start)))
+        failures, = cursor.fetchone()
+
+        cursor.execute(*queue.join(subscription,
+                condition=queue.subscription == subscription.id
+                ).select(Count(queue.id),
+                where=of_company & (queue.state == 'failed')))
+        failed_jobs, = cursor.fetchone()
+
+        return {
+            'states': states,
+            'processing': states.get('processing', 0),
+            'due_occurrences': due_occurrences or 0,
+            'due_amount': due_amount,
+            'failures': failures or 0,
+            'failed_jobs': failed_jobs or 0,
+            }
     
     @classmethod
     @ModelView.button
     @Workflow.transition('stop')
     def stop(cls, subscriptions):
-        for subscription in subscriptions:
-            Pool().get('ir.cron').write([subscription.cron], {'active': False})
-            cls.write([subscription], {'state':'stop'})
+        Cron = Pool().get('ir.cron')
+        crons = [s.cron for s in subscriptions if s.cron]
+        if crons:
+            Cron.write(crons, {'active': False})
+        cls._update_seats(subscriptions, -1)
+        cls.write(subscriptions, {'state': 'stop'})
 
 class TrainingSubscriptionLine(ModelView, ModelSQL):
     'Training Subscription Line'
     __name__ = 'training.subscription.line'
+    _sale_price_cache = Cache('training.subscription.line.sale_price',
+        size_limit=10240)
 
     subscription =fields.Many2One('training.subscription', 'Subscription',
                                             required=True,
-                                            ondelete='CASCADE')
+                                            ondelete='CASCADE', select=True)
     session = fields.Many2One('training.session', 'Session', required=True,
             domain=[('state', 'in', ['open']),],
             on_change=['session', 'uom', 'quantity', 
@@ -681,12 +1800,29 @@ class TrainingSubscriptionLine(ModelView, ModelSQL):
     uom = fields.Many2One('product.uom', 'UOM', depends=['session'])
     number_calls = fields.Integer('Number of documents', states=STATES)
     total_amount = fields.Function(fields.Numeric('Total Amount', 
-            digits=(16, 2)), 'get_total_amount')
+            digits=(16, 2)), 'get_total_amount',
+        searcher='search_total_amount')
     notes = fields.Char('Notes')
 
     @classmethod
     def __setup__(cls):
         super(TrainingSubscriptionLine, cls).__setup__()
+        cls._error_messages.update({
+                'duplicate_enrollment': 'The student "%s" is already '
+                'subscribed to the session "%s".',
+                'delete_confirmed': ('The line of session "%s" can not be '
+                    'deleted as its subscription "%s" is confirmed.'),
+                })
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().cursor
+
+        super(TrainingSubscriptionLine, cls).__register__(module_name)
+
+        table = TableHandler(cursor, cls, module_name)
+        table.index_action(['session', 'subscription'], 'add')
     
     @staticmethod
     def default_state():
@@ -695,15 +1831,99 @@ class TrainingSubscriptionLine(ModelView, ModelSQL):
     @staticmethod
     def default_quantity():
         return 1
+
+    @classmethod
+    def validate(cls, lines):
+        super(TrainingSubscriptionLine, cls).validate(lines)
+        cls.check_duplicate_enrollments(lines)
+
+    @classmethod
+    def delete(cls, lines):
+        # The lines of confirmed subscriptions hold a seat of their session
+        for line in lines:
+            if line.subscription.state in CONFIRMED_STATES:
+                cls.raise_user_error('delete_confirmed', (
+                        line.session.rec_name, line.subscription.rec_name))
+        super(TrainingSubscriptionLine, cls).delete(lines)
+
+    @classmethod
+    def check_duplicate_enrollments(cls, lines):
+        '''
+        Check that the students of the lines are not subscribed twice to
+        the same session by subscriptions which are not canceled.
+        '''
+        pool = Pool()
+        Subscription = pool.get('training.subscription')
+        line = cls.__table__()
+        other_line = cls.__table__()
+        subscription = Subscription.__table__()
+        other_subscription = Subscription.__table__()
+        cursor = Transaction().cursor
+
+        ids = [l.id for l in lines]
+        for i in range(0, len(ids), cursor.IN_MAX):
+            sub_ids = ids[i:i + cursor.IN_MAX]
+            cursor.execute(*line.join(subscription,
+                    condition=line.subscription == subscription.id
+                    ).join(other_subscription,
+                    condition=(other_subscription.student
+                        == subscription.student)
+                    & (other_subscription.state != 'cancel')
+                    ).join(other_line,
+                    condition=(other_line.subscription
+                        == other_subscription.id)
+                    & (other_line.session == line.session)
+                    & (other_line.id != line.id)
+                    ).select(line.id,
+                    where=line.id.in_(sub_ids)
+                    & (subscription.state != 'cancel'),
+                    limit=1))
+            duplicate = cursor.fetchone()
+            if duplicate:
+                duplicate = cls(duplicate[0])
+                cls.raise_user_error('duplicate_enrollment', (
+                        duplicate.subscription.student.rec_name,
+                        duplicate.session.rec_name))
     
-    def get_total_amount(self, name):
+    @staticmethod
+    def _get_amount_column(table):
+        return Coalesce(table.quantity, _ZERO) * Coalesce(table.unit_price,
+            _ZERO)
+
+    @classmethod
+    def get_total_amount(cls, lines, name):
         '''
         The total amount of session subscription.
         '''
-        res = Decimal(0)
-        if self.quantity and self.unit_price:
-            res = self.quantity * self.unit_price
-        return res
+        table = cls.__table__()
+        cursor = Transaction().cursor
+
+        ids = [l.id for l in lines]
+        amounts = dict((i, _ZERO) for i in ids)
+        for i in range(0, len(ids), cursor.IN_MAX):
+            sub_ids = ids[i:i + cursor.IN_MAX]
+            cursor.execute(*table.select(table.id,
+                    cls._get_amount_column(table),
+                    where=table.id.in_(sub_ids)))
+            for line_id, amount in cursor.fetchall():
+                if not isinstance(amount, Decimal):
+                    amount = Decimal(str(amount))
+                amounts[line_id] = amount
+        return amounts
+
+    @classmethod
+    def search_total_amount(cls, name, clause):
+        table = cls.__table__()
+        _, operator, value = clause
+        return [('id', 'in', table.select(table.id,
+                    where=_get_sql_clause(cls._get_amount_column(table),
+                        operator, value)))]
+
+    @staticmethod
+    def order_total_amount(tables):
+        Line = Pool().get('training.subscription.line')
+        table, _ = tables[None]
+        return [Line._get_amount_column(table)]
     
     def on_change_unit_price(self):
         res = {'total_amount':0}
@@ -713,19 +1933,19 @@ class TrainingSubscriptionLine(ModelView, ModelSQL):
         return res 
     
     def on_change_session(self):
-        Product = Pool().get('product.product')
         res = {}
         if self.session:
             res = {'uom': self.session.offer.name.default_uom.id}
-            with Transaction().set_context(self._get_context_subscription_price(self.subscription)):
-                for session_product in self.session.offer.name.products: 
-                    product = session_product
-
-                res['unit_price'] = Product.get_sale_price([product],
-                        self.quantity or 0)[product.id]
-                if res['unit_price']:
-                    res['unit_price'] = res['unit_price'].quantize(
-                        Decimal(1) / 10 ** self.__class__.unit_price.digits[1])
+            for session_product in self.session.offer.name.products: 
+                product = session_product
+
+            res['unit_price'], = self.get_sale_prices([(product,
+                        self.quantity or 0,
+                        self._get_context_subscription_price(
+                            self.subscription))])
+            if res['unit_price']:
+                res['unit_price'] = res['unit_price'].quantize(
+                    Decimal(1) / 10 ** self.__class__.unit_price.digits[1])
             self.unit_price = res['unit_price']
             res['number_calls'] = self.session.offer.number_calls
             if self.quantity and self.unit_price:
@@ -733,6 +1953,65 @@ class TrainingSubscriptionLine(ModelView, ModelSQL):
                 res['total_amount'] = total
         return res
     
+    @classmethod
+    def get_sale_prices(cls, requests):
+        '''
+        Return the list of sale prices for the list of
+        (product, quantity, context) requests.
+        The products sharing the same quantity and context are priced at
+        once and the prices are cached.
+        '''
+        Product = Pool().get('product.product')
+
+        # The keys of the transaction context the price depends on
+        transaction_context = Transaction().context
+        prices = [None] * len(requests)
+        to_price = {}
+        for i, (product, quantity, context) in enumerate(requests):
+            pricing = tuple((k, context.get(k, transaction_context.get(k)))
+                for k in SALE_PRICE_CONTEXT)
+            context = tuple(sorted(context.iteritems()))
+            price = cls._sale_price_cache.get(
+                (product.id, quantity, context, pricing))
+            if price is not None:
+                prices[i] = price
+            else:
+                to_price.setdefault((quantity, context, pricing), []).append(
+                    (i, product))
+
+        for (quantity, context, pricing), values in to_price.iteritems():
+            products = list(set(p for _, p in values))
+            with Transaction().set_context(dict(context)):
+                product_prices = Product.get_sale_price(products, quantity)
+            for i, product in values:
+                price = product_prices[product.id]
+                prices[i] = price
+                if price is not None:
+                    cls._sale_price_cache.set(
+                        (product.id, quantity, context, pricing), price)
+        return prices
+
+    @classmethod
+    def reprice(cls, lines):
+        '''
+        Set the unit price of the lines from their subscription price list
+        '''
+        digits = cls.unit_price.digits[1]
+        requests = []
+        for line in lines:
+            for session_product in line.session.offer.name.products:
+                product = session_product
+            requests.append((product, line.quantity or 0,
+                    line._get_context_subscription_price(line.subscription)))
+
+        to_write = {}
+        for line, price in zip(lines, cls.get_sale_prices(requests)):
+            if price:
+                price = price.quantize(Decimal(1) / 10 ** digits)
+            to_write.setdefault(price, []).append(line)
+        for price, price_lines in to_write.iteritems():
+            cls.write(price_lines, {'unit_price': price})
+
     def _get_context_subscription_price(self, subscription):
         context = {}
         if getattr(self, 'subscription', None):
@@ -794,29 +2073,514 @@ class TrainingSubscriptionHistory(ModelSQL, ModelView):
 
     @classmethod
     def get_model(cls):
-        cr = Transaction().cursor
-        cr.execute('''\
-            SELECT
-                m.model,
-                m.name
-            FROM
-                ir_model m
-            ORDER BY
-                m.name
-        ''')
-        return cr.fetchall()
+        Configuration = Pool().get('training.configuration')
+        return Configuration.get_source_models()
 
     date = fields.DateTime('Date', readonly=True)
     log = fields.Char('Result', readonly=True)
     subscription = fields.Many2One('training.subscription',
-            'Subscription', ondelete='CASCADE', readonly=True)
+            'Subscription', ondelete='CASCADE', readonly=True, select=True)
     document = fields.Reference('Created Document', selection='get_model',
             readonly=True)
+    phases = fields.One2Many('training.subscription.history.phase',
+        'history', 'Phases', readonly=True)
+    success = fields.Boolean('Success', readonly=True)
 
     @staticmethod
     def default_date():
         return datetime.now()
 
+    @staticmethod
+    def default_success():
+        return True
+
+
+class TrainingSubscriptionHistoryPhase(ModelSQL, ModelView):
+    'Subscription History Phase'
+    __name__ = 'training.subscription.history.phase'
+
+    history = fields.Many2One('training.subscription.history', 'History',
+        required=True, ondelete='CASCADE', select=True, readonly=True)
+    phase = fields.Selection(PHASES, 'Phase', required=True, readonly=True)
+    duration = fields.Float('Duration', digits=(16, 3), readonly=True,
+        help='Wall-clock time in seconds.')
+    queries = fields.Integer('Queries', readonly=True)
+
+
+class TrainingSubscriptionPhaseStatistics(ModelSQL, ModelView):
+    'Subscription Phase Statistics'
+    __name__ = 'training.subscription.phase.statistics'
+
+    phase = fields.Selection(PHASES, 'Phase', readonly=True)
+    number = fields.Integer('Number', readonly=True)
+    average = fields.Float('Average', digits=(16, 3), readonly=True)
+    p50 = fields.Function(fields.Float('P50', digits=(16, 3)),
+        'get_percentile')
+    p95 = fields.Function(fields.Float('P95', digits=(16, 3)),
+        'get_percentile')
+    maximum = fields.Float('Maximum', digits=(16, 3), readonly=True)
+    average_queries = fields.Float('Average Queries', digits=(16, 1),
+        readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(TrainingSubscriptionPhaseStatistics, cls).__setup__()
+        cls._order.insert(0, ('phase', 'ASC'))
+
+    @staticmethod
+    def _get_date_where(history):
+        context = Transaction().context
+        where = Literal(True)
+        if context.get('from_date'):
+            where &= history.date >= datetime.combine(context['from_date'],
+                datetime.min.time())
+        if context.get('to_date'):
+            where &= history.date <= datetime.combine(context['to_date'],
+                datetime.max.time())
+        return where
+
+    @classmethod
+    def table_query(cls):
+        pool = Pool()
+        Phase = pool.get('training.subscription.history.phase')
+        History = pool.get('training.subscription.history')
+        phase = Phase.__table__()
+        history = History.__table__()
+        return phase.join(history,
+            condition=phase.history == history.id
+            ).select(
+            Max(phase.id).as_('id'),
+            Max(phase.create_uid).as_('create_uid'),
+            Max(phase.create_date).as_('create_date'),
+            Max(phase.write_uid).as_('write_uid'),
+            Max(phase.write_date).as_('write_date'),
+            phase.phase,
+            Count(phase.id).as_('number'),
+            Avg(phase.duration).as_('average'),
+            Max(phase.duration).as_('maximum'),
+            Avg(phase.queries).as_('average_queries'),
+            where=cls._get_date_where(history),
+            group_by=phase.phase)
+
+    @classmethod
+    def get_percentile(cls, statistics, name):
+        pool = Pool()
+        Phase = pool.get('training.subscription.history.phase')
+        History = pool.get('training.subscription.history')
+        phase = Phase.__table__()
+        history = History.__table__()
+        cursor = Transaction().cursor
+
+        percent = int(name[1:])
+        percentiles = {}
+        for statistic in statistics:
+            if not statistic.number:
+                percentiles[statistic.id] = None
+                continue
+            # Nearest-rank percentile, only the ranked row is fetched
+            rank = int(math.ceil(percent / 100. * statistic.number))
+            cursor.execute(*phase.join(history,
+                    condition=phase.history == history.id
+                    ).select(phase.duration,
+                    where=(phase.phase == statistic.phase)
+                    & cls._get_date_where(history),
+                    order_by=phase.duration,
+                    limit=1, offset=max(rank - 1, 0)))
+            row = cursor.fetchone()
+            percentiles[statistic.id] = row[0] if row else None
+        return percentiles
+
+
+class OpenPhaseStatisticsStart(ModelView):
+    'Open Phase Statistics'
+    __name__ = 'training.subscription.phase.statistics.open.start'
+
+    from_date = fields.Date('From Date')
+    to_date = fields.Date('To Date')
+
+    @staticmethod
+    def default_to_date():
+        Date_ = Pool().get('ir.date')
+        return Date_.today()
+
+
+class OpenPhaseStatistics(Wizard):
+    'Open Phase Statistics'
+    __name__ = 'training.subscription.phase.statistics.open'
+
+    start = StateView('training.subscription.phase.statistics.open.start',
+        'training_subscription.phase_statistics_open_start_view_form', [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Open', 'open_', 'tryton-ok', default=True),
+            ])
+    open_ = StateAction('training_subscription.act_phase_statistics')
+
+    def do_open_(self, action):
+        action['pyson_context'] = PYSONEncoder().encode({
+                'from_date': self.start.from_date,
+                'to_date': self.start.to_date,
+                })
+        return action, {}
+
+class TrainingSubscriptionForecast(ModelSQL, ModelView):
+    'Subscription Forecast'
+    __name__ = 'training.subscription.forecast'
+
+    company = fields.Many2One('company.company', 'Company', readonly=True)
+    session = fields.Many2One('training.session', 'Session', readonly=True)
+    year = fields.Integer('Year', readonly=True)
+    month = fields.Integer('Month', readonly=True)
+    number = fields.Integer('Documents', readonly=True)
+    amount = fields.Numeric('Amount', digits=(16, 2), readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(TrainingSubscriptionForecast, cls).__setup__()
+        cls._order.insert(0, ('year', 'ASC'))
+        cls._order.insert(1, ('month', 'ASC'))
+        cls._order.insert(2, ('session', 'ASC'))
+
+    @staticmethod
+    def _get_dates():
+        '''
+        Return the forecast range from the context, by default the next
+        twelve months
+        '''
+        context = Transaction().context
+        from_date = context.get('from_date') or datetime.today().date()
+        to_date = (context.get('to_date')
+            or from_date + relativedelta(months=12, days=-1))
+        return (datetime.combine(from_date, datetime.min.time()),
+            datetime.combine(to_date, datetime.max.time()))
+
+    @classmethod
+    def _get_query(cls, company, from_date, to_date):
+        '''
+        Return the query of the amounts billed by the pending occurrences
+        of the processing subscriptions per session and month
+        '''
+        pool = Pool()
+        Occurrence = pool.get('training.subscription.occurrence')
+        Subscription = pool.get('training.subscription')
+        Line = pool.get('training.subscription.line')
+        occurrence = Occurrence.__table__()
+        subscription = Subscription.__table__()
+        line = Line.__table__()
+
+        # EXTRACT returns a float and the ids must be integer
+        year = Cast(Extract('YEAR', occurrence.due_date), 'INTEGER')
+        month = Cast(Extract('MONTH', occurrence.due_date), 'INTEGER')
+        # The session is shifted in BIGINT to not overflow
+        id_ = (Cast(line.session, 'BIGINT') * 1000000 + year * 100 + month)
+        return occurrence.join(subscription,
+            condition=occurrence.subscription == subscription.id
+            ).join(line, condition=line.subscription == subscription.id
+            ).select(
+            Max(id_).as_('id'),
+            subscription.company,
+            line.session,
+            year.as_('year'),
+            month.as_('month'),
+            Count(occurrence.id).as_('number'),
+            Sum(Line._get_amount_column(line)).as_('amount'),
+            where=(occurrence.state == 'pending')
+            & (occurrence.due_date >= from_date)
+            & (occurrence.due_date <= to_date)
+            & (subscription.state == 'processing')
+            & (subscription.company == company),
+            group_by=[subscription.company, line.session, year, month])
+
+    @classmethod
+    def table_query(cls):
+        query = cls._get_query(Transaction().context.get('company'),
+            *cls._get_dates())
+        return query.select(query.id,
+            Literal(0).as_('create_uid'),
+            CurrentTimestamp().as_('create_date'),
+            Literal(None).as_('write_uid'),
+            Literal(None).as_('write_date'),
+            query.company, query.session, query.year, query.month,
+            query.number, query.amount)
+
+    @classmethod
+    def forecast(cls, company, from_date, to_date):
+        '''
+        Return the list of (session id, year, month, documents, amount)
+        billed by the company between the dates
+        '''
+        cursor = Transaction().cursor
+        query = cls._get_query(company,
+            datetime.combine(from_date, datetime.min.time()),
+            datetime.combine(to_date, datetime.max.time()))
+        cursor.execute(*query)
+        forecast = []
+        for _, _, session, year, month, number, amount in cursor.fetchall():
+            if not isinstance(amount, Decimal):
+                amount = Decimal(str(amount or 0))
+            forecast.append((session, int(year), int(month), number,
+                    amount))
+        return forecast
+
+
+class OpenForecastStart(ModelView):
+    'Open Forecast'
+    __name__ = 'training.subscription.forecast.open.start'
+
+    from_date = fields.Date('From Date', required=True)
+    to_date = fields.Date('To Date', required=True)
+
+    @staticmethod
+    def default_from_date():
+        Date_ = Pool().get('ir.date')
+        return Date_.today()
+
+    @staticmethod
+    def default_to_date():
+        Date_ = Pool().get('ir.date')
+        return Date_.today() + relativedelta(months=12, days=-1)
+
+
+class OpenForecast(Wizard):
+    'Open Forecast'
+    __name__ = 'training.subscription.forecast.open'
+
+    start = StateView('training.subscription.forecast.open.start',
+        'training_subscription.forecast_open_start_view_form', [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Open', 'open_', 'tryton-ok', default=True),
+            ])
+    open_ = StateAction('training_subscription.act_forecast')
+
+    def do_open_(self, action):
+        action['pyson_context'] = PYSONEncoder().encode({
+                'from_date': self.start.from_date,
+                'to_date': self.start.to_date,
+                })
+        return action, {}
+
+
+class TrainingSubscriptionOccurrence(ModelSQL, ModelView):
+    'Subscription Occurrence'
+    __name__ = 'training.subscription.occurrence'
+    _rec_name = 'due_date'
+
+    subscription = fields.Many2One('training.subscription', 'Subscription',
+        required=True, ondelete='CASCADE', select=True, readonly=True)
+    number = fields.Integer('Number', readonly=True)
+    due_date = fields.DateTime('Due Date', required=True, readonly=True,
+        help='The billing date of the occurrence.')
+    run_at = fields.DateTime('Run At', required=True, readonly=True,
+        help='The time the dispatcher bills the occurrence.')
+    state = fields.Selection([
+            ('pending', 'Pending'),
+            ('done', 'Done'),
+            ('cancel', 'Canceled'),
+            ], 'State', required=True, readonly=True)
+    document = fields.Reference('Created Document', selection='get_model',
+        readonly=True)
+    attempts = fields.Integer('Attempts', readonly=True,
+        help='Number of failed billings of the occurrence.')
+
+    @classmethod
+    def __setup__(cls):
+        super(TrainingSubscriptionOccurrence, cls).__setup__()
+        cls._order.insert(0, ('due_date', 'ASC'))
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().cursor
+        sql_table = cls.__table__()
+
+        # Migration from occurrences run on their due date
+        migrate_run_at = False
+        if TableHandler.table_exist(cursor, cls._table):
+            table = TableHandler(cursor, cls, module_name)
+            migrate_run_at = not table.column_exist('run_at')
+
+        super(TrainingSubscriptionOccurrence, cls).__register__(module_name)
+
+        if migrate_run_at:
+            cursor.execute(*sql_table.update(
+                    columns=[sql_table.run_at],
+                    values=[sql_table.due_date]))
+
+        table = TableHandler(cursor, cls, module_name)
+        table.index_action(['state', 'due_date'], 'add')
+        table.index_action(['state', 'run_at'], 'add')
+
+    @classmethod
+    def get_model(cls):
+        Subscription = Pool().get('training.subscription')
+        return Subscription.get_model()
+
+    @staticmethod
+    def default_state():
+        return 'pending'
+
+    @staticmethod
+    def default_attempts():
+        return 0
+
+    @classmethod
+    def postpone(cls, occurrences):
+        '''
+        Postpone the run of the occurrences which failed to be billed with
+        an exponential backoff. The due date is not changed.
+        '''
+        now = datetime.now()
+        for occurrence in occurrences:
+            attempts = (occurrence.attempts or 0) + 1
+            cls.write([occurrence], {
+                    'attempts': attempts,
+                    'run_at': now + QUEUE_RETRY_DELAY * 2 ** (attempts - 1),
+                    })
+
+
+class TrainingSubscriptionQueue(ModelSQL, ModelView):
+    'Subscription Queue'
+    __name__ = 'training.subscription.queue'
+
+    subscription = fields.Many2One('training.subscription', 'Subscription',
+        required=True, ondelete='CASCADE', select=True, readonly=True)
+    state = fields.Selection([
+            ('pending', 'Pending'),
+            ('done', 'Done'),
+            ('failed', 'Failed'),
+            ], 'State', required=True, readonly=True)
+    attempts = fields.Integer('Attempts', readonly=True)
+    next_try = fields.DateTime('Next Try', readonly=True)
+    error = fields.Text('Error', readonly=True)
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().cursor
+
+        super(TrainingSubscriptionQueue, cls).__register__(module_name)
+
+        table = TableHandler(cursor, cls, module_name)
+        table.index_action(['state', 'next_try'], 'add')
+
+    @classmethod
+    def __setup__(cls):
+        super(TrainingSubscriptionQueue, cls).__setup__()
+        cls._buttons.update({
+                'requeue': {
+                    'invisible': Eval('state') != 'failed',
+                    },
+                })
+
+    @staticmethod
+    def default_state():
+        return 'pending'
+
+    @staticmethod
+    def default_attempts():
+        return 0
+
+    @staticmethod
+    def default_next_try():
+        return datetime.now()
+
+    @classmethod
+    def enqueue(cls, subscriptions):
+        '''
+        Queue the creation of the sales of the subscriptions
+        '''
+        cls.create([{'subscription': s.id} for s in subscriptions])
+
+    @classmethod
+    @ModelView.button
+    def requeue(cls, jobs):
+        '''
+        Try again the failed jobs
+        '''
+        cls.write([j for j in jobs if j.state == 'failed'], {
+                'state': 'pending',
+                'attempts': 0,
+                'next_try': datetime.now(),
+                })
+
+    @classmethod
+    def run(cls):
+        '''
+        Create the sales of the pending jobs by batches.
+        Each batch is committed on its own and, if it fails, its jobs are
+        retried one by one to isolate the failures.
+        '''
+        Subscription = Pool().get('training.subscription')
+        cursor = Transaction().cursor
+
+        while True:
+            jobs = cls.search([
+                    ('state', '=', 'pending'),
+                    ('next_try', '<=', datetime.now()),
+                    ], order=[('id', 'ASC')], limit=cursor.IN_MAX)
+            if not jobs:
+                break
+            job_ids = [j.id for j in jobs]
+            try:
+                Subscription._create_sales([j.subscription for j in jobs])
+                cls._done(jobs)
+                cursor.commit()
+            except Exception:
+                cursor.rollback()
+                for job in cls.browse(job_ids):
+                    cls._run_job(job)
+
+    @classmethod
+    def _run_job(cls, job):
+        Subscription = Pool().get('training.subscription')
+        cursor = Transaction().cursor
+        try:
+            Subscription._create_sales([job.subscription])
+            cls._done([job])
+            cursor.commit()
+        except Exception:
+            error = traceback.format_exc()
+            cursor.rollback()
+            cls._fail(cls(job.id), error)
+            cursor.commit()
+
+    @classmethod
+    def _done(cls, jobs):
+        cls.write(jobs, {
+                'state': 'done',
+                'error': None,
+                })
+
+    @classmethod
+    def _fail(cls, job, error):
+        '''
+        Record the failure and schedule the next try with an exponential
+        backoff
+        '''
+        pool = Pool()
+        Configuration = pool.get('training.configuration')
+        Subscription = pool.get('training.subscription')
+        History = pool.get('training.subscription.history')
+
+        attempts = job.attempts + 1
+        vals = {
+            'attempts': attempts,
+            'error': error,
+            }
+        if attempts >= Configuration(1).queue_max_attempts:
+            vals['state'] = 'failed'
+        else:
+            vals['next_try'] = (datetime.now()
+                + QUEUE_RETRY_DELAY * 2 ** (attempts - 1))
+        cls.write([job], vals)
+        History.create([{
+                    'subscription': job.subscription.id,
+                    'success': False,
+                    'log': Subscription.raise_user_error(
+                        error='sales_failed',
+                        error_args=(attempts, error.strip().splitlines()[-1]),
+                        raise_exception=False),
+                    }])
+
 class Sale:
     'Sale'
     __name__ = 'sale.sale'
@@ -834,15 +2598,93 @@ class TrainingSession(ModelView, ModelSQL):
    
     count_subscriptions = fields.Function(
                                 fields.Integer('Confirmed Subscriptions'),
-                                'get_subscriptions_count')
+                                'get_subscriptions_count',
+                                searcher='search_subscriptions_count')
+    capacity = fields.Integer('Capacity',
+        help='Maximum number of confirmed subscriptions.\n'
+            'Leave empty for no limit.')
+    seats_taken = fields.Integer('Seats Taken', readonly=True)
+    seats_available = fields.Function(fields.Integer('Seats Available'),
+        'get_seats_available')
+
+    @classmethod
+    def __register__(cls, module_name):
+        pool = Pool()
+        SubscriptionLine = pool.get('training.subscription.line')
+        Subscription = pool.get('training.subscription')
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().cursor
+        sql_table = cls.__table__()
+        line = SubscriptionLine.__table__()
+        subscription = Subscription.__table__()
+
+        # Migration from sessions without seat counter
+        table = TableHandler(cursor, cls, module_name)
+        migrate_seats = not table.column_exist('seats_taken')
+
+        super(TrainingSession, cls).__register__(module_name)
+
+        if migrate_seats:
+            cursor.execute(*sql_table.update(
+                    columns=[sql_table.seats_taken],
+                    values=[line.join(subscription,
+                            condition=line.subscription == subscription.id
+                            ).select(Count(line.id),
+                            where=(line.session == sql_table.id)
+                            & subscription.state.in_(CONFIRMED_STATES))]))
+
+    @staticmethod
+    def default_seats_taken():
+        return 0
+
+    def get_seats_available(self, name):
+        if self.capacity:
+            return max(self.capacity - (self.seats_taken or 0), 0)
     
     #participants = fields.Function(fields.Char('Students'),
     #                               'get_participants')
     
-    def get_subscriptions_count(self, name):
+    @classmethod
+    def get_subscriptions_count(cls, sessions, name):
         pool = Pool()
         SubscriptionLine = pool.get('training.subscription.line')
-        return SubscriptionLine.search_count([ ('session', '=', self.id) ])
+        Subscription = pool.get('training.subscription')
+        line = SubscriptionLine.__table__()
+        subscription = Subscription.__table__()
+        cursor = Transaction().cursor
+
+        ids = [s.id for s in sessions]
+        counts = dict((i, 0) for i in ids)
+        for i in range(0, len(ids), cursor.IN_MAX):
+            sub_ids = ids[i:i + cursor.IN_MAX]
+            cursor.execute(*line.join(subscription,
+                    condition=line.subscription == subscription.id
+                    ).select(line.session, Count(line.id),
+                    where=line.session.in_(sub_ids)
+                    & subscription.state.in_(CONFIRMED_STATES),
+                    group_by=line.session))
+            counts.update(cursor.fetchall())
+        return counts
+
+    @classmethod
+    def search_subscriptions_count(cls, name, clause):
+        pool = Pool()
+        SubscriptionLine = pool.get('training.subscription.line')
+        Subscription = pool.get('training.subscription')
+        session = cls.__table__()
+        line = SubscriptionLine.__table__()
+        subscription = Subscription.__table__()
+
+        _, operator, value = clause
+        query = session.join(line, 'LEFT',
+            condition=line.session == session.id
+            ).join(subscription, 'LEFT',
+            condition=(line.subscription == subscription.id)
+            & subscription.state.in_(CONFIRMED_STATES)
+            ).select(session.id,
+            group_by=session.id,
+            having=_get_sql_clause(Count(subscription.id), operator, value))
+        return [('id', 'in', query)]
     
    # def get_participants(self, name):
    #     pool = Pool()